@@ -0,0 +1,138 @@
+#
+# Copyright 2018 Picovoice Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import queue
+import threading
+
+import numpy as np
+import soundfile
+
+from dataset import Dataset
+
+# Format and subtype used for compressed test audio.
+ENCODINGS = {
+    'flac': ('FLAC', 'PCM_16'),
+    'opus': ('OGG', 'OPUS'),
+}
+
+
+def raw_path(path):
+    return '%s.pcm' % os.path.splitext(path)[0]
+
+
+def convert_to_raw(path, block_length=Dataset.sample_rate() * 60):
+    res = raw_path(path)
+
+    with soundfile.SoundFile(path) as f:
+        assert f.samplerate == Dataset.sample_rate()
+        assert f.channels == 1
+
+        tmp_path = '%s.tmp' % res
+        pcm = np.memmap(tmp_path, dtype=np.int16, mode='w+', shape=(f.frames,))
+        start_index = 0
+        for block in f.blocks(blocksize=block_length, dtype=np.int16):
+            pcm[start_index:(start_index + block.size)] = block
+            start_index += block.size
+        pcm.flush()
+        del pcm
+
+    os.replace(tmp_path, res)
+
+    return res
+
+
+def memmap(path):
+    return np.memmap(raw_path(path), dtype=np.int16, mode='r')
+
+
+def encoded_path(path, encoding):
+    return '%s.%s' % (os.path.splitext(path)[0], encoding)
+
+
+def encode(path, encoding, block_length=Dataset.sample_rate() * 60):
+    res = encoded_path(path, encoding)
+    file_format, subtype = ENCODINGS[encoding]
+
+    tmp_path = '%s.tmp' % res
+    with soundfile.SoundFile(path) as f:
+        with soundfile.SoundFile(
+                tmp_path,
+                'w',
+                samplerate=f.samplerate,
+                channels=f.channels,
+                format=file_format,
+                subtype=subtype) as encoded_f:
+            for block in f.blocks(blocksize=block_length, dtype=np.int16):
+                encoded_f.write(block)
+
+    os.replace(tmp_path, res)
+
+    return res
+
+
+# Read-only view of a (possibly compressed) audio file that decodes the samples of a slice when it is taken.
+class EncodedAudio(object):
+    def __init__(self, path):
+        self._path = path
+        self._file = None
+        self.size = soundfile.info(path).frames
+
+    def __getitem__(self, key):
+        start, stop, _ = key.indices(self.size)
+
+        if self._file is None:
+            self._file = soundfile.SoundFile(self._path)
+        self._file.seek(start)
+
+        return self._file.read(max(0, stop - start), dtype=np.int16)
+
+
+# Iterates over `iterable` on a background thread that runs at most `queue_size` items ahead, so that reading and
+# decoding audio overlaps with processing it.
+def prefetch(iterable, queue_size=4):
+    items = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    end = object()
+
+    def produce():
+        try:
+            for x in iterable:
+                items.put((x, None))
+                if stop.is_set():
+                    return
+            items.put((end, None))
+        except Exception as e:
+            items.put((None, e))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            x, error = items.get()
+            if error is not None:
+                raise error
+            if x is end:
+                break
+            yield x
+    finally:
+        stop.set()
+        while thread.is_alive():
+            try:
+                items.get(timeout=0.1)
+            except queue.Empty:
+                pass
@@ -15,126 +15,510 @@
 #
 
 import argparse
+import hashlib
+import json
 import logging
 import multiprocessing
 import os
+import shutil
+import time
 
 import numpy as np
-import soundfile
 
+import audio
+from cache import (
+    TestFileCache,
+    evict
+)
+from checkpoint import (
+    Checkpoint,
+    Progress
+)
 from dataset import (
     Dataset,
     Datasets
 )
 from engine import (
+    DetectorPool,
     Engine,
-    Engines
+    RuntimeInfo
+)
+from mixer import (
+    SEED,
+    BackgroundTimeline,
+    MixedSpeech,
+    NoiseTimeline,
+    create_snr_sweep_files,
+    create_test_files
+)
+from results import (
+    ResultStore,
+    new_run_id
+)
+from scheduler import (
+    BisectionSweep,
+    GridSweep,
+    LinearSweep,
+    Scheduler
+)
+from score import (
+    Trace,
+    detection_latencies,
+    detection_latency,
+    keyword_intervals,
+    read_labels,
+    run_trace_dir,
+    save_trace,
+    score
+)
+from work_queue import (
+    QueuePool,
+    open_queue
 )
-from mixer import create_test_files
 
 logging.basicConfig(format='%(asctime)s:%(levelname)s:%(message)s', level=logging.INFO)
 
 
-def run_sensitivity(pcm, num_frames, labels, num_keywords, engine_type, sensitivity):
-    detector = Engine.create(engine_type, keyword=args.keyword, sensitivity=sensitivity, access_key=args.access_key)
+def _sensitivity_results(sensitivities, detectors, detections):
+    res = dict()
+    for j, sensitivity in enumerate(sensitivities):
+        res[sensitivity] = np.concatenate(detections[j] + [np.zeros((0,), dtype=np.int64)]), detectors[j].runtime_info()
+
+    return res
+
 
+def read_blocks(pcm, start_frame, end_frame, block_num_frames):
     frame_length = Engine.frame_length()
 
-    num_false_alarms = 0
-    num_true_detects = 0
-    for i in range(num_frames):
-        frame = pcm[(i * frame_length):((i + 1) * frame_length)]
-        if detector.process(frame):
-            if labels[i]:
-                num_true_detects += 1
-            else:
-                num_false_alarms += 1
+    for block_start_frame in range(start_frame, end_frame, block_num_frames):
+        block_end_frame = min(block_start_frame + block_num_frames, end_frame)
+        block = np.array(pcm[(block_start_frame * frame_length):(block_end_frame * frame_length)], dtype=np.int16)
+        yield block_start_frame, block_end_frame, block
 
-    detector.release()
 
-    miss_rate = (num_keywords - num_true_detects) / num_keywords
-    pcm_length_hour = pcm.size / (Dataset.sample_rate() * 3600)
-    false_alarm_per_hour = num_false_alarms / pcm_length_hour
+_detector_pool = DetectorPool()
 
-    logging.info(
-        '[%s - %.2f] fr: %.2f fa: %.2f' % (engine_type.value, sensitivity, miss_rate, false_alarm_per_hour))
 
-    return miss_rate, false_alarm_per_hour
+# Blocks of test audio are read (and decoded or mixed) on a background thread while the detectors process earlier ones.
+# `progress` is called after each block with the end frame of the block and a function returning the results so far.
+def run_sensitivities(
+        pcm, start_frame, end_frame, engine_type, keyword, sensitivities, block_num_frames=1875, progress=None):
+    detectors = [
+        _detector_pool.acquire(engine_type, keyword=keyword, sensitivity=x, access_key=args.access_key)
+        for x in sensitivities]
 
+    detections = [list() for _ in detectors]
+    blocks = audio.prefetch(read_blocks(pcm, start_frame, end_frame, block_num_frames))
+    for block_start_frame, block_end_frame, block in blocks:
+        for j, detector in enumerate(detectors):
+            detections[j].append(detector.process_batch(block) + block_start_frame)
 
-def run(engine_type, min_false_alarm=0.1, max_false_alarm=0.1):
-    pcm, sample_rate = soundfile.read(speech_path, dtype=np.int16)
-    assert sample_rate == Dataset.sample_rate()
+        if progress is not None:
+            progress(block_end_frame, lambda: _sensitivity_results(sensitivities, detectors, detections))
 
-    keyword_times_sec = list()
-    with open(label_path, 'r') as f:
-        for line in f.readlines():
-            keyword_times_sec.append(tuple(float(x) for x in line.strip('\n').split(', ')))
+    res = _sensitivity_results(sensitivities, detectors, detections)
 
-    frame_length = Engine.frame_length()
-    num_frames = pcm.size // frame_length
+    for detector in detectors:
+        _detector_pool.release(engine_type, keyword, detector)
+
+    return res
+
+
+def test_file_paths(path, keyword):
+    return os.path.join(path, '%s_speech.wav' % keyword), os.path.join(path, '%s_label.txt' % keyword)
+
+
+def snr_sweep_file_paths(path, keyword):
+    return os.path.join(path, '%s_sweep' % keyword), os.path.join(path, '%s_label.txt' % keyword)
+
+
+_test_files = dict()
+
+_test_data = dict()
+
+
+def load_test_data(keyword, snr_db=None):
+    if (keyword, snr_db) not in _test_data:
+        speech_path, label_path = _test_files[keyword]
+
+        if snr_db is None and args.test_audio_encoding is None:
+            pcm = audio.memmap(speech_path)
+        elif snr_db is None:
+            pcm = audio.EncodedAudio(speech_path)
+        else:
+            pcm = MixedSpeech(speech_path, snr_db)
+        num_frames = pcm.size // Engine.frame_length()
+
+        keyword_times_sec = read_labels(label_path)
+        intervals = keyword_intervals(keyword_times_sec)
+
+        _test_data[keyword, snr_db] = pcm, num_frames, intervals, keyword_times_sec
+
+    return _test_data[keyword, snr_db]
 
-    labels = np.zeros((num_frames,), dtype=bool)
-    for start_sec, end_sec in keyword_times_sec:
-        start_frame = int(start_sec * Dataset.sample_rate() // frame_length)
-        end_frame = int((end_sec * Dataset.sample_rate() + (frame_length - 1)) // frame_length)
-        labels[start_frame:(end_frame + 1)] = True
 
-    sensitivity_info = Engine.sensitivity_info(engine_type)
+_checkpoint = None
+
+
+def _combine_progress(progress, start_frame, frame, res):
+    if progress is None:
+        return dict((x, (y[y >= start_frame], z)) for x, (y, z) in res.items())
+
+    weights = [progress.frame - start_frame, frame - progress.frame]
+    return dict(
+        (x, (np.concatenate([progress.detections[x], y[y >= progress.frame]]),
+             _merge_runtime_infos([progress.runtime_infos[x], z], weights)))
+        for x, (y, z) in res.items())
+
+
+# Each shard is preceded by a warm-up of `args.shard_warmup_sec` whose detections belong to the previous shard and are
+# dropped, so that the detector's state at the shard boundary approximates the one of a serial run. The progress of
+# the pass is checkpointed every `args.checkpoint_interval_sec`. A pass that resumes from a checkpoint restarts its
+# detectors a warm-up before the checkpointed frame, just as a shard does.
+def run(engine_type, keyword, snr_db, sensitivities, shard=0, num_shards=1):
+    pcm, num_frames, _, _ = load_test_data(keyword, snr_db)
+
+    start_frame = (num_frames * shard) // num_shards
+    end_frame = (num_frames * (shard + 1)) // num_shards
+    warmup_num_frames = int(args.shard_warmup_sec * Dataset.sample_rate()) // Engine.frame_length()
+
+    checkpoint_args = engine_type.value, keyword, snr_db, sensitivities, shard, num_shards
+    progress = _checkpoint.load_progress(*checkpoint_args)
+    resume_frame = start_frame
+    if progress is not None:
+        logging.info('[%s] resuming %s from frame %d' % (engine_type.value, sensitivities, progress.frame))
+        resume_frame = progress.frame
+
+    last_checkpoint_sec = [time.time()]
+
+    def checkpoint(frame, results):
+        if time.time() - last_checkpoint_sec[0] >= args.checkpoint_interval_sec and resume_frame < frame < end_frame:
+            res = _combine_progress(progress, start_frame, frame, results())
+            _checkpoint.save_progress(
+                *checkpoint_args,
+                progress=Progress(
+                    frame=frame,
+                    detections=dict((x, y[0]) for x, y in res.items()),
+                    runtime_infos=dict((x, y[1]) for x, y in res.items())))
+            last_checkpoint_sec[0] = time.time()
+
+    res = run_sensitivities(
+        pcm,
+        max(0, resume_frame - warmup_num_frames),
+        end_frame,
+        engine_type,
+        keyword,
+        sensitivities,
+        progress=checkpoint)
+
+    return _combine_progress(progress, start_frame, end_frame, res)
+
+
+def _merge_runtime_infos(runtime_infos, weights):
+    weights = np.array(weights, dtype=np.float64) / sum(weights)
+
+    return RuntimeInfo(
+        init_sec=max(x.init_sec for x in runtime_infos),
+        real_time_factor=sum(x.real_time_factor * y for x, y in zip(runtime_infos, weights)),
+        mean_latency_ms=sum(x.mean_latency_ms * y for x, y in zip(runtime_infos, weights)),
+        p50_latency_ms=sum(x.p50_latency_ms * y for x, y in zip(runtime_infos, weights)),
+        p99_latency_ms=sum(x.p99_latency_ms * y for x, y in zip(runtime_infos, weights)),
+        max_latency_ms=max(x.max_latency_ms for x in runtime_infos))
+
+
+def merge(engine_type, keyword, snr_db, shard_results):
+    pcm, num_frames, intervals, keyword_times_sec = load_test_data(keyword, snr_db)
+    shard_lengths = [((num_frames * (i + 1)) // len(shard_results)) - ((num_frames * i) // len(shard_results))
+                     for i in range(len(shard_results))]
 
     res = dict()
+    for sensitivity in shard_results[0].keys():
+        detections = np.concatenate([x[sensitivity][0] for x in shard_results])
+        runtime_info = _merge_runtime_infos([x[sensitivity][1] for x in shard_results], shard_lengths)
+
+        save_trace(
+            run_trace_dir(args.trace_dir, args.run_id),
+            Trace(
+                engine=engine_type.value,
+                keyword=keyword,
+                sensitivity=sensitivity,
+                detections=detections,
+                num_samples=pcm.size,
+                keyword_times_sec=keyword_times_sec,
+                snr_db=args.snr_db if snr_db is None else snr_db))
+
+        miss_rate, false_alarm_per_hour, num_extra_detections = score(detections, intervals, pcm.size)
+        latency = detection_latency(detection_latencies(detections, intervals, keyword_times_sec))
+
+        logging.info(
+            '[%s - %.2f] fr: %.2f fa: %.2f extra: %d rtf: %.4f latency: %.0f ms' %
+            (engine_type.value,
+             sensitivity,
+             miss_rate,
+             false_alarm_per_hour,
+             num_extra_detections,
+             runtime_info.real_time_factor,
+             latency.mean_ms))
+
+        res[sensitivity] = miss_rate, false_alarm_per_hour, runtime_info, latency, num_extra_detections
+        _checkpoint.save_result(engine_type.value, keyword, snr_db, sensitivity, res[sensitivity])
+
+    _checkpoint.remove_progress(engine_type.value, keyword, snr_db, list(shard_results[0].keys()), len(shard_results))
+
+    return res
+
+
+def finished(engine_type, keyword, snr_db, sensitivities):
+    res = dict()
+    for sensitivity in sensitivities:
+        result = _checkpoint.load_result(engine_type.value, keyword, snr_db, sensitivity)
+        if result is not None:
+            logging.info('[%s - %.2f] finished in an earlier run' % (engine_type.value, sensitivity))
+            res[sensitivity] = result
+
+    return res
+
 
-    sensitivity = (sensitivity_info.min + sensitivity_info.max) / 2
+# Everything a worker process of a distributed run needs, besides the shared test files and the access key, to run
+# tasks of this run. The access key is left out because the context is stored on the shared storage of the work queue.
+def job_context(checkpoint_path):
+    return dict(
+        args=dict(vars(args), access_key=None),
+        test_files=dict((x, tuple(os.path.abspath(z) for z in y)) for x, y in _test_files.items()),
+        checkpoint_path=os.path.abspath(checkpoint_path))
 
-    while sensitivity >= sensitivity_info.min and (len(res) == 0 or min(x[1] for x in res.values()) > min_false_alarm):
-        res[sensitivity] = run_sensitivity(pcm, num_frames, labels, len(keyword_times_sec), engine_type, sensitivity)
-        sensitivity -= sensitivity_info.step
 
-    sensitivity = (sensitivity_info.min + sensitivity_info.max) / 2 + sensitivity_info.step
+def set_job_context(context, access_key):
+    global args
+    global _checkpoint
 
-    while sensitivity <= sensitivity_info.max and max(x[1] for x in res.values()) < max_false_alarm:
-        res[sensitivity] = run_sensitivity(pcm, num_frames, labels, len(keyword_times_sec), engine_type, sensitivity)
-        sensitivity += sensitivity_info.step
+    args = argparse.Namespace(**dict(context['args'], access_key=access_key))
 
-    return engine_type, res
+    _test_files.clear()
+    _test_files.update(context['test_files'])
+    _test_data.clear()
+    _checkpoint = Checkpoint(context['checkpoint_path'])
 
 
-def save(results):
-    for engine, result in results:
-        path = os.path.join(os.path.dirname(__file__), '%s_%s.csv' % (args.keyword, engine.value))
-        with open(path, 'w') as f:
-            for sensitivity in sorted(result.keys()):
-                miss_rate, false_alarms_per_hour = result[sensitivity]
-                f.write('%f, %f\n' % (miss_rate, false_alarms_per_hour))
+def save(sweeps):
+    store = ResultStore(args.results_path)
+    for sweep in sweeps:
+        snr_db = args.snr_db if sweep.snr_db is None else sweep.snr_db
+        store.insert(args.run_id, sweep.engine_type.value, sweep.keyword, snr_db, sweep.results())
+    store.close()
+
+    logging.info("stored the results of run '%s' in '%s'" % (args.run_id, args.results_path))
 
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--librispeech_dataset_path', required=True)
 parser.add_argument('--demand_dataset_path', required=True)
-parser.add_argument('--keyword', required=True)
+keyword_group = parser.add_mutually_exclusive_group(required=True)
+keyword_group.add_argument('--keyword')
+keyword_group.add_argument(
+    '--keywords',
+    nargs='+',
+    help='benchmark several keywords in one run, sharing the background speech and noise of their test files')
 parser.add_argument('--access-key', required=True)
+search_group = parser.add_mutually_exclusive_group()
+search_group.add_argument(
+    '--fan-out',
+    action='store_true',
+    help='evaluate every sensitivity of an engine in a single pass over the test audio')
+search_group.add_argument(
+    '--bisection',
+    action='store_true',
+    help='bracket the 0.1 false alarms per hour point of each engine and bisect the bracketing step')
+parser.add_argument('--num-processes', type=int, default=multiprocessing.cpu_count())
+parser.add_argument(
+    '--queue',
+    help='publish tasks to this work queue (a shared directory or sqlite:///path) for worker.py processes to run '
+         'instead of running them locally, --num-processes is then the number of tasks in flight')
+parser.add_argument(
+    '--num-shards',
+    type=int,
+    default=1,
+    help='split the test audio into this many segments, each processed by its own detector in its own task')
+parser.add_argument(
+    '--shard-warmup-sec',
+    type=float,
+    default=30,
+    help='audio fed to a shard\'s detector before its segment starts, detections within it are discarded')
+parser.add_argument(
+    '--test-audio-encoding',
+    choices=sorted(audio.ENCODINGS.keys()),
+    help='keep the test audio compressed and decode it while benchmarking instead of storing it as raw PCM')
+parser.add_argument('--length-hour', type=float, default=24)
+snr_group = parser.add_mutually_exclusive_group()
+snr_group.add_argument('--snr-db', type=float, default=10)
+snr_group.add_argument(
+    '--snr-dbs',
+    nargs='+',
+    type=float,
+    help='benchmark at each of these SNRs, mixing the variants on the fly from a single speech track and noise bed')
+parser.add_argument('--results-path', default=os.path.join(os.path.dirname(__file__), 'results.db'))
+parser.add_argument('--run-id', default=new_run_id(), help='identifies the results of this run in the results store')
+parser.add_argument('--trace-dir', default=os.path.join(os.path.dirname(__file__), 'traces'))
+parser.add_argument('--cache-dir', default=os.path.join(os.path.dirname(__file__), 'cache'))
+parser.add_argument(
+    '--cache-size-gb',
+    type=float,
+    default=50,
+    help='generated test files and decoded datasets are evicted, least recently used first, once the cache grows '
+         'beyond this size')
+parser.add_argument(
+    '--checkpoint-interval-sec',
+    type=float,
+    default=300,
+    help='how often the progress of a pass over the test audio is saved so that an interrupted run can resume it')
+parser.add_argument(
+    '--resume',
+    metavar='RUN_ID',
+    help='continue an interrupted run, using its saved results and progress and storing the results under its run id')
+parser.add_argument(
+    '--decode-datasets',
+    action='store_true',
+    help='decode the datasets once into a memory-mapped store under the cache directory and read samples from it')
 
 if __name__ == '__main__':
     args = parser.parse_args()
-
-    keyword_dataset =\
-        Dataset.create(Datasets.KEYWORD, os.path.join(os.path.dirname(__file__), 'audio/%s' % args.keyword))
-    logging.info('loaded keyword dataset with %d examples' % keyword_dataset.size())
-
-    background_dataset = Dataset.create(Datasets.LIBRI_SPEECH, args.librispeech_dataset_path, exclude_word=args.keyword)
+    if args.test_audio_encoding is not None and args.snr_dbs is not None:
+        parser.error('--test-audio-encoding cannot be combined with --snr-dbs')
+
+    keywords = args.keywords if args.keywords is not None else [args.keyword]
+
+    keyword_datasets = list()
+    for keyword in keywords:
+        keyword_datasets.append(
+            Dataset.create(Datasets.KEYWORD, os.path.join(os.path.dirname(__file__), 'audio/%s' % keyword)))
+        logging.info("loaded '%s' keyword dataset with %d examples" % (keyword, keyword_datasets[-1].size()))
+
+    background_dataset = Dataset.create(
+        Datasets.LIBRI_SPEECH,
+        args.librispeech_dataset_path,
+        exclude_words=keywords,
+        index_path=os.path.join(args.cache_dir, 'librispeech'))
     logging.info('loaded librispeech dataset with %d examples' % background_dataset.size())
 
     noise_dataset = Dataset.create(Datasets.DEMAND, args.demand_dataset_path)
     logging.info('loaded demand dataset with %d examples' % noise_dataset.size())
 
-    speech_path = os.path.join(os.path.dirname(__file__), '%s_speech.wav' % args.keyword)
-    label_path = os.path.join(os.path.dirname(__file__), '%s_label.txt' % args.keyword)
-    create_test_files(
-        speech_path=speech_path,
-        label_path=label_path,
-        keyword_dataset=keyword_dataset,
-        background_dataset=background_dataset,
-        noise_dataset=noise_dataset)
+    decoded_paths = list()
+    if args.decode_datasets:
+        for dataset in keyword_datasets + [background_dataset, noise_dataset]:
+            decoded_paths.append(dataset.use_decoded_cache(os.path.join(args.cache_dir, 'corpus')))
+
+    def create(path):
+        background_timeline = BackgroundTimeline(background_dataset)
+        noise_timeline = NoiseTimeline(noise_dataset)
+
+        for keyword, keyword_dataset in zip(keywords, keyword_datasets):
+            if args.snr_dbs is not None:
+                sweep_path, label_path = snr_sweep_file_paths(path, keyword)
+                create_snr_sweep_files(
+                    sweep_path=sweep_path,
+                    label_path=label_path,
+                    keyword_dataset=keyword_dataset,
+                    background_dataset=background_dataset,
+                    noise_dataset=noise_dataset,
+                    snr_dbs=args.snr_dbs,
+                    length_hour=args.length_hour,
+                    background_timeline=background_timeline,
+                    noise_timeline=noise_timeline)
+                continue
+
+            speech_path, label_path = test_file_paths(path, keyword)
+            create_test_files(
+                speech_path=speech_path,
+                label_path=label_path,
+                keyword_dataset=keyword_dataset,
+                background_dataset=background_dataset,
+                noise_dataset=noise_dataset,
+                length_hour=args.length_hour,
+                snr_db=args.snr_db,
+                background_timeline=background_timeline,
+                noise_timeline=noise_timeline)
+
+            if args.test_audio_encoding is None:
+                audio.convert_to_raw(speech_path)
+            else:
+                audio.encode(speech_path, args.test_audio_encoding)
+            os.remove(speech_path)
 
-    with multiprocessing.Pool() as pool:
-        save(pool.map(run, [x for x in Engines]))
+    test_files_key = TestFileCache.key(
+        keywords=keywords,
+        keyword_datasets=keyword_datasets,
+        background_dataset=background_dataset,
+        noise_dataset=noise_dataset,
+        length_hour=args.length_hour,
+        snr_db=args.snr_db if args.snr_dbs is None else args.snr_dbs,
+        encoding=args.test_audio_encoding,
+        seed=SEED)
+    cache = TestFileCache(os.path.join(args.cache_dir, 'test_files'))
+    test_files_path = cache.fetch(test_files_key, create)
+    evict(
+        [os.path.join(args.cache_dir, x) for x in ('test_files', 'corpus')],
+        int(args.cache_size_gb * (1024 ** 3)),
+        keep=[test_files_path] + decoded_paths)
+    for keyword in keywords:
+        if args.snr_dbs is None:
+            speech_path, label_path = test_file_paths(test_files_path, keyword)
+            if args.test_audio_encoding is not None:
+                speech_path = audio.encoded_path(speech_path, args.test_audio_encoding)
+            _test_files[keyword] = speech_path, label_path
+        else:
+            _test_files[keyword] = snr_sweep_file_paths(test_files_path, keyword)
+
+    if args.fan_out:
+        sweep_class = GridSweep
+    elif args.bisection:
+        sweep_class = BisectionSweep
+    else:
+        sweep_class = LinearSweep
+    engine_types = list()
+    for engine_type in Engine.types():
+        try:
+            Engine.backend(engine_type)
+            engine_types.append(engine_type)
+        except (ImportError, OSError) as e:
+            logging.warning("skipping '%s' engine as its backend failed to load: %s" % (engine_type.value, e))
+    logging.info('benchmarking %s' % ', '.join(x.value for x in engine_types))
+
+    snr_dbs = [None] if args.snr_dbs is None else args.snr_dbs
+    sweeps = [sweep_class(x, y, snr_db=z) for z in snr_dbs for y in keywords for x in engine_types]
+
+    # Saved results and progress belong to one run and are only used by a run that resumes it with the same test files,
+    # engine versions, sharding and search. They are removed once the results are stored.
+    if args.resume is not None:
+        args.run_id = args.resume
+    run_settings = dict(
+        test_files=test_files_key,
+        engines=dict((x.value, Engine.backend(x).version()) for x in engine_types),
+        num_shards=args.num_shards,
+        shard_warmup_sec=args.shard_warmup_sec,
+        search=sweep_class.__name__)
+    run_checkpoint_path = os.path.join(args.cache_dir, 'checkpoints', args.run_id)
+    checkpoint_path = os.path.join(
+        run_checkpoint_path,
+        hashlib.sha256(json.dumps(run_settings, sort_keys=True).encode()).hexdigest())
+    if args.resume is not None and not os.path.exists(checkpoint_path):
+        if os.path.exists(run_checkpoint_path):
+            parser.error(
+                "run '%s' was started with other test files, engine versions, sharding or search settings" %
+                args.resume)
+        else:
+            parser.error("there is no interrupted run '%s' to resume" % args.resume)
+    _checkpoint = Checkpoint(checkpoint_path)
+    logging.info("run '%s' can be resumed with '--resume %s' if it is interrupted" % (args.run_id, args.run_id))
+
+    if args.queue is None:
+        pool = multiprocessing.Pool(args.num_processes)
+    else:
+        pool = QueuePool(open_queue(args.queue), job_context(checkpoint_path))
+        logging.info("publishing tasks to '%s'" % args.queue)
+
+    with pool:
+        scheduler = Scheduler(pool, args.num_processes, run, merge, num_shards=args.num_shards, finished=finished)
+        save(scheduler.run(sweeps))
+
+    shutil.rmtree(run_checkpoint_path)
@@ -0,0 +1,149 @@
+#
+# Copyright 2018 Picovoice Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+import numpy as np
+import soundfile
+
+
+def _dir_size(path):
+    res = 0
+    for dir_path, _, file_names in os.walk(path):
+        for x in file_names:
+            res += os.path.getsize(os.path.join(dir_path, x))
+
+    return res
+
+
+# Removes the least recently used entries of the cache `directories` until they take at most `max_size_bytes` together.
+# Entries in `keep` are in use and are not removed.
+def evict(directories, max_size_bytes, keep=()):
+    entries = list()
+    for x in directories:
+        if not os.path.isdir(x):
+            continue
+        for y in os.listdir(x):
+            path = os.path.join(x, y)
+            if os.path.isdir(path) and not y.endswith('.tmp'):
+                entries.append((os.path.getmtime(path), path, _dir_size(path)))
+
+    keep = set(os.path.abspath(x) for x in keep)
+    size_bytes = sum(x[2] for x in entries)
+    for _, path, entry_size_bytes in sorted(entries):
+        if size_bytes <= max_size_bytes:
+            break
+        if os.path.abspath(path) in keep:
+            continue
+
+        logging.info("evicting cache entry '%s'" % path)
+        shutil.rmtree(path)
+        size_bytes -= entry_size_bytes
+
+
+class TestFileCache(object):
+    # Bumped whenever the content or format of generated test files changes.
+    VERSION = 3
+
+    def __init__(self, path):
+        self._path = path
+
+        os.makedirs(self._path, exist_ok=True)
+
+    @staticmethod
+    def key(keywords, keyword_datasets, background_dataset, noise_dataset, length_hour, snr_db, encoding, seed):
+        inputs = dict(
+            keywords=keywords,
+            keyword_datasets=[x.paths() for x in keyword_datasets],
+            background_dataset=background_dataset.paths(),
+            noise_dataset=noise_dataset.paths(),
+            length_hour=length_hour,
+            snr_db=snr_db,
+            encoding=encoding,
+            seed=seed,
+            version=TestFileCache.VERSION)
+
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+    def fetch(self, key, create):
+        path = os.path.join(self._path, key)
+
+        if os.path.isdir(path):
+            logging.info("reusing cached test files in '%s'" % path)
+            os.utime(path)
+            return path
+
+        tmp_path = '%s.tmp' % path
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+
+        create(tmp_path)
+        os.replace(tmp_path, path)
+
+        return path
+
+
+# All files of a dataset root decoded into one memory-mapped array. Datasets that use a subset of the files of the root
+# share the store of the root.
+class DecodedCorpus(object):
+    def __init__(self, path, paths, sample_rate):
+        path = os.path.join(path, hashlib.sha256(json.dumps(paths).encode()).hexdigest())
+        if os.path.isdir(path):
+            os.utime(path)
+        else:
+            self._build(path, paths, sample_rate)
+        self.path = path
+
+        self._pcm = np.memmap(os.path.join(path, 'pcm.bin'), dtype=np.int16, mode='r')
+        index = np.load(os.path.join(path, 'index.npy'))
+        self._offsets = index[0]
+        self._max_abs = index[1]
+
+    def get(self, index):
+        return self._pcm[self._offsets[index]:self._offsets[index + 1]]
+
+    def length(self, index):
+        return int(self._offsets[index + 1] - self._offsets[index])
+
+    def max_abs(self, index):
+        return int(self._max_abs[index])
+
+    @staticmethod
+    def _build(path, paths, sample_rate):
+        logging.info("decoding %d files into '%s'" % (len(paths), path))
+
+        tmp_path = '%s.tmp' % path
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+
+        index = np.zeros((2, len(paths) + 1), dtype=np.int64)
+        with open(os.path.join(tmp_path, 'pcm.bin'), 'wb') as f:
+            for i, x in enumerate(paths):
+                pcm, pcm_sample_rate = soundfile.read(x, dtype=np.int16)
+                assert pcm_sample_rate == sample_rate
+
+                pcm.tofile(f)
+                index[0, i + 1] = index[0, i] + pcm.size
+                index[1, i] = max(int(np.max(pcm)), abs(int(np.min(pcm)))) if pcm.size > 0 else 0
+        np.save(os.path.join(tmp_path, 'index.npy'), index)
+
+        os.replace(tmp_path, path)
@@ -0,0 +1,112 @@
+#
+# Copyright 2018 Picovoice Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import hashlib
+import json
+import os
+from collections import namedtuple
+
+import numpy as np
+
+from engine import RuntimeInfo
+from score import (
+    DetectionLatency,
+    result_name
+)
+
+Progress = namedtuple('Progress', 'frame, detections, runtime_infos')
+
+
+def _write_atomically(path, write):
+    tmp_path = '%s.tmp' % path
+    with open(tmp_path, 'wb') as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+
+# Results of finished sensitivities and the progress of passes that are still running, so that an interrupted benchmark
+# can pick up where it stopped. Files are replaced atomically and hence a crash never leaves a partial one behind.
+class Checkpoint(object):
+    def __init__(self, path):
+        self._path = path
+
+        os.makedirs(self._path, exist_ok=True)
+
+    def save_result(self, engine, keyword, snr_db, sensitivity, result):
+        miss_rate, false_alarm_per_hour, runtime_info, latency, num_extra_detections = result
+        data = dict(
+            miss_rate=miss_rate,
+            false_alarm_per_hour=false_alarm_per_hour,
+            runtime_info=list(runtime_info),
+            latency=list(latency),
+            num_extra_detections=int(num_extra_detections))
+
+        _write_atomically(
+            self._result_path(engine, keyword, snr_db, sensitivity),
+            lambda f: f.write(json.dumps(data).encode()))
+
+    def load_result(self, engine, keyword, snr_db, sensitivity):
+        path = self._result_path(engine, keyword, snr_db, sensitivity)
+        if not os.path.exists(path):
+            return None
+
+        with open(path, 'r') as f:
+            data = json.load(f)
+
+        return (
+            data['miss_rate'],
+            data['false_alarm_per_hour'],
+            RuntimeInfo(*data['runtime_info']),
+            DetectionLatency(*data['latency']),
+            data['num_extra_detections'])
+
+    def save_progress(self, engine, keyword, snr_db, sensitivities, shard, num_shards, progress):
+        _write_atomically(
+            self._progress_path(engine, keyword, snr_db, sensitivities, shard, num_shards),
+            lambda f: np.savez(
+                f,
+                frame=np.array(progress.frame, dtype=np.int64),
+                detections=np.concatenate([progress.detections[x] for x in sensitivities]),
+                detection_counts=np.array([progress.detections[x].size for x in sensitivities], dtype=np.int64),
+                runtime_infos=np.array([progress.runtime_infos[x] for x in sensitivities], dtype=np.float64)))
+
+    def load_progress(self, engine, keyword, snr_db, sensitivities, shard, num_shards):
+        path = self._progress_path(engine, keyword, snr_db, sensitivities, shard, num_shards)
+        if not os.path.exists(path):
+            return None
+
+        with np.load(path) as x:
+            detections = np.split(x['detections'], np.cumsum(x['detection_counts'])[:-1])
+            return Progress(
+                frame=int(x['frame']),
+                detections=dict(zip(sensitivities, detections)),
+                runtime_infos=dict((s, RuntimeInfo(*y)) for s, y in zip(sensitivities, x['runtime_infos'].tolist())))
+
+    def remove_progress(self, engine, keyword, snr_db, sensitivities, num_shards):
+        for shard in range(num_shards):
+            path = self._progress_path(engine, keyword, snr_db, sensitivities, shard, num_shards)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _result_path(self, engine, keyword, snr_db, sensitivity):
+        return os.path.join(self._path, '%s_%f.json' % (result_name(keyword, engine, snr_db), sensitivity))
+
+    def _progress_path(self, engine, keyword, snr_db, sensitivities, shard, num_shards):
+        sensitivities_hash = hashlib.sha256(json.dumps(list(sensitivities)).encode()).hexdigest()[:16]
+
+        return os.path.join(
+            self._path,
+            '%s_%s_%d_of_%d.npz' % (result_name(keyword, engine, snr_db), sensitivities_hash, shard, num_shards))
@@ -14,12 +14,17 @@
 # limitations under the License.
 #
 
+import hashlib
+import json
 import os
+from collections import namedtuple
 from enum import Enum
 
 import numpy as np
 import soundfile
 
+from cache import DecodedCorpus
+
 
 class Datasets(Enum):
     DEMAND = 'DEMAND'
@@ -30,19 +35,60 @@ class Datasets(Enum):
 class Dataset(object):
     def __init__(self):
         self._random = np.random.RandomState(seed=778)
+        self._decoded = None
+        self._decoded_indices = None
 
     def get(self, index, dtype=np.int16):
+        if self._decoded is not None:
+            pcm = self._decoded.get(self._decoded_indices[index])
+            if dtype == np.float32:
+                return pcm.astype(np.float32) / 32768
+            return np.array(pcm, dtype=dtype)
+
         pcm, sample_rate = soundfile.read(self._paths[index], dtype=dtype)
         assert sample_rate == self.sample_rate()
 
         return pcm
 
+    def get_normalized(self, index):
+        pcm = self.get(index, dtype=np.float32)
+        if self._decoded is not None:
+            max_abs = np.float32(self._decoded.max_abs(self._decoded_indices[index])) / np.float32(32768)
+        else:
+            max_abs = max(np.max(pcm), np.abs(np.min(pcm)))
+
+        return pcm / max_abs
+
     def random(self, dtype=np.int16):
-        return self.get(self._random.randint(low=0, high=self.size()), dtype=dtype)
+        return self.get(self.random_index(), dtype=dtype)
+
+    def random_index(self):
+        return self._random.randint(low=0, high=self.size())
+
+    def length(self, index):
+        if self._decoded is not None:
+            return self._decoded.length(self._decoded_indices[index])
+
+        return soundfile.info(self._paths[index]).frames
+
+    # Reads samples from the decoded store of the dataset root under `path`, which is built on first use. Returns the
+    # path of the store.
+    def use_decoded_cache(self, path):
+        root_paths, self._decoded_indices = self._root()
+        self._decoded = DecodedCorpus(path, root_paths, self.sample_rate())
+
+        return self._decoded.path
+
+    # All files under the root of the dataset and the index among them of each file of the dataset.
+    def _root(self):
+        return self.paths(), list(range(self.size()))
 
     def size(self):
         return len(self._paths)
 
+    def paths(self):
+        return list(self._paths)
+
     @staticmethod
     def sample_rate():
         return 16000
@@ -54,7 +100,7 @@ class Dataset(object):
         elif dataset is Datasets.KEYWORD:
             return KeywordDataset(path)
         elif dataset is Datasets.LIBRI_SPEECH:
-            return LibriSpeechDataset(path, *kwargs)
+            return LibriSpeechDataset(path, **kwargs)
         else:
             raise ValueError("cannot create dataset of type '%s'", dataset.value)
 
@@ -91,22 +137,100 @@ class KeywordDataset(Dataset):
         return self.__paths
 
 
+_Utterance = namedtuple('_Utterance', 'id, path, length, words')
+
+
+class _LibriSpeechIndex(object):
+    def __init__(self, signature, utterances, word_index):
+        self.signature = signature
+        self.utterances = utterances
+        self.word_index = word_index
+
+    def matching(self, phrases):
+        res = set()
+        for phrase in phrases:
+            words = phrase.upper().split()
+            if len(words) > 0:
+                res |= set.intersection(*[set(self.word_index.get(x, [])) for x in words])
+
+        return res
+
+    @staticmethod
+    def signature(path):
+        res = list()
+        for speaker_id in sorted(os.listdir(path)):
+            speaker_dir = os.path.join(path, speaker_id)
+            for chapter_id in sorted(os.listdir(speaker_dir)):
+                transcript_path = os.path.join(speaker_dir, chapter_id, '%s-%s.trans.txt' % (speaker_id, chapter_id))
+                res.append([speaker_id, chapter_id, os.path.getmtime(transcript_path)])
+
+        return res
+
+    @classmethod
+    def build(cls, path, signature):
+        utterances = list()
+        for speaker_id, chapter_id, _ in signature:
+            transcript_path = os.path.join(path, speaker_id, chapter_id, '%s-%s.trans.txt' % (speaker_id, chapter_id))
+            with open(transcript_path) as f:
+                for line in f.readlines():
+                    flac_basename, transcript = line.split(' ', maxsplit=1)
+                    flac_path = os.path.join(speaker_id, chapter_id, '%s.flac' % flac_basename)
+                    utterances.append(_Utterance(
+                        id=flac_basename,
+                        path=flac_path,
+                        length=soundfile.info(os.path.join(path, flac_path)).frames,
+                        words=sorted(set(transcript.upper().split()))))
+        utterances.sort(key=lambda x: x.path)
+
+        word_index = dict()
+        for i, utterance in enumerate(utterances):
+            for word in utterance.words:
+                word_index.setdefault(word, list()).append(i)
+
+        return cls(signature, utterances, word_index)
+
+    @classmethod
+    def load(cls, path, index_path=None):
+        signature = cls.signature(path)
+        if index_path is None:
+            return cls.build(path, signature)
+
+        cache_path = os.path.join(index_path, '%s.json' % hashlib.sha256(os.path.abspath(path).encode()).hexdigest())
+        if os.path.exists(cache_path):
+            with open(cache_path) as f:
+                x = json.load(f)
+            if x['signature'] == signature:
+                return cls(signature, [_Utterance(*y) for y in x['utterances']], x['word_index'])
+
+        res = cls.build(path, signature)
+
+        os.makedirs(index_path, exist_ok=True)
+        with open('%s.tmp' % cache_path, 'w') as f:
+            json.dump(
+                dict(signature=res.signature, utterances=[list(y) for y in res.utterances], word_index=res.word_index),
+                f)
+        os.replace('%s.tmp' % cache_path, cache_path)
+
+        return res
+
+
 class LibriSpeechDataset(Dataset):
-    def __init__(self, path, exclude_word):
+    def __init__(self, path, exclude_words=(), index_path=None):
         super(LibriSpeechDataset, self).__init__()
 
-        self.__paths = list()
-        for speaker_id in os.listdir(path):
-            speaker_dir = os.path.join(path, speaker_id)
-            for chapter_id in os.listdir(speaker_dir):
-                chapter_dir = os.path.join(speaker_dir, chapter_id)
-                transcript_path = os.path.join(chapter_dir, '%s-%s.trans.txt' % (speaker_id, chapter_id))
-                with open(transcript_path) as f:
-                    for line in f.readlines():
-                        flac_basename, transcript = line.split(' ', maxsplit=1)
-                        if exclude_word not in transcript:
-                            self.__paths.append(os.path.join(chapter_dir, '%s.flac' % flac_basename))
-        self.__paths.sort()
+        index = _LibriSpeechIndex.load(path, index_path)
+        excluded = index.matching(exclude_words)
+
+        self.__root_paths = [os.path.join(path, x.path) for x in index.utterances]
+        self.__indices = [i for i in range(len(index.utterances)) if i not in excluded]
+        self.__paths = [self.__root_paths[i] for i in self.__indices]
+        self.__lengths = [index.utterances[i].length for i in self.__indices]
+
+    def length(self, index):
+        return self.__lengths[index]
+
+    def _root(self):
+        return list(self.__root_paths), list(self.__indices)
 
     @property
     def _paths(self):
@@ -15,18 +15,19 @@
 #
 
 import os
+import time
+from array import array
 from collections import namedtuple
 from enum import Enum
+from importlib.metadata import (
+    PackageNotFoundError,
+    entry_points,
+    version
+)
 
 import numpy as np
-import pvporcupine
-from pocketsphinx import (
-    Config,
-    Decoder,
-    get_model_path
-)
 
-from engines import snowboydetect
+from dataset import Dataset
 
 
 class Engines(Enum):
@@ -35,11 +36,95 @@ class Engines(Enum):
     SNOWBOY = 'Snowboy'
 
 
+# Engines of other packages are registered as entry points in this group. The name of an entry point is the name of the
+# engine and it refers to an `Engine` subclass that is constructed with the keyword, the sensitivity and keyword
+# arguments such as `access_key`, and that provides `sensitivity_range()`. It can implement `_reset()`,
+# `set_sensitivity()` and `set_keyword()` so that its detectors are reused.
+ENTRY_POINT_GROUP = 'wake_word_benchmark.engines'
+
+ExternalEngine = namedtuple('ExternalEngine', 'value')
+
+
+# Before Python 3.10, `entry_points()` takes no arguments and returns a dict of groups.
+def _entry_points():
+    try:
+        return entry_points(group=ENTRY_POINT_GROUP)
+    except TypeError:
+        return entry_points().get(ENTRY_POINT_GROUP, [])
+
+
 SensitivityInfo = namedtuple('SensitivityInfo', 'min, max, step')
 
+RuntimeInfo = namedtuple(
+    'RuntimeInfo',
+    'init_sec, real_time_factor, mean_latency_ms, p50_latency_ms, p99_latency_ms, max_latency_ms')
+
 
 class Engine(object):
+    def __init__(self):
+        self._init_time_ns = 0
+        self._latencies_ns = array('q')
+
     def process(self, pcm):
+        assert pcm.dtype == np.int16
+
+        start_ns = time.perf_counter_ns()
+        res = self._process(self._frames(pcm)[0])
+        self._latencies_ns.append(time.perf_counter_ns() - start_ns)
+
+        return res
+
+    def process_batch(self, pcm):
+        assert pcm.dtype == np.int16
+        assert pcm.size % self.frame_length() == 0
+
+        res = list()
+        for i, frame in enumerate(self._frames(pcm)):
+            start_ns = time.perf_counter_ns()
+            detected = self._process(frame)
+            self._latencies_ns.append(time.perf_counter_ns() - start_ns)
+            if detected:
+                res.append(i)
+
+        return np.array(res, dtype=np.int64)
+
+    def runtime_info(self):
+        latencies_ms = np.frombuffer(self._latencies_ns, dtype=np.int64) / 1e6
+        if latencies_ms.size == 0:
+            return RuntimeInfo(self._init_time_ns / 1e9, 0., 0., 0., 0., 0.)
+
+        audio_length_ms = latencies_ms.size * self.frame_length() * 1e3 / Dataset.sample_rate()
+        p50_latency_ms, p99_latency_ms = np.percentile(latencies_ms, [50, 99])
+
+        return RuntimeInfo(
+            init_sec=self._init_time_ns / 1e9,
+            real_time_factor=latencies_ms.sum() / audio_length_ms,
+            mean_latency_ms=latencies_ms.mean(),
+            p50_latency_ms=p50_latency_ms,
+            p99_latency_ms=p99_latency_ms,
+            max_latency_ms=latencies_ms.max())
+
+    def _frames(self, pcm):
+        return pcm.reshape((-1, self.frame_length()))
+
+    # Returns the detector to the state of a new one, keeping the loaded model. Engines that cannot do this raise
+    # `NotImplementedError`.
+    def reset(self):
+        self._reset()
+        self._latencies_ns = array('q')
+
+    def set_sensitivity(self, sensitivity):
+        raise NotImplementedError()
+
+    # Makes the detector detect `keyword` instead, keeping the loaded model. Engines whose model depends on the keyword
+    # raise `NotImplementedError`.
+    def set_keyword(self, keyword, sensitivity):
+        raise NotImplementedError()
+
+    def _process(self, frame):
+        raise NotImplementedError()
+
+    def _reset(self):
         raise NotImplementedError()
 
     def release(self):
@@ -48,10 +133,27 @@ class Engine(object):
     def __str__(self):
         raise NotImplementedError()
 
+    @staticmethod
+    def load():
+        return None
+
+    # Version of the package providing the engine, if it can be determined.
+    @classmethod
+    def version(cls):
+        module = cls.load()
+        try:
+            return version((cls.__module__ if module is None else module.__name__).split('.')[0])
+        except PackageNotFoundError:
+            return getattr(module, '__version__', None)
+
     @staticmethod
     def frame_length():
         return 512
 
+    @staticmethod
+    def types():
+        return list(Engines) + [ExternalEngine(x.name) for x in _entry_points()]
+
     @staticmethod
     def sensitivity_info(engine_type):
         if engine_type is Engines.POCKET_SPHINX:
@@ -61,37 +163,162 @@ class Engine(object):
         elif engine_type is Engines.SNOWBOY:
             return SensitivityInfo(0, 1, 0.05)
         else:
-            raise ValueError("no sensitivity range for '%s'", engine_type.value)
+            return Engine.backend(engine_type).sensitivity_range()
+
+    # Sensitivity range of an engine that is not built in, which its class provides.
+    @classmethod
+    def sensitivity_range(cls):
+        raise NotImplementedError("engine class '%s' does not provide sensitivity_range()" % cls.__name__)
+
+    # Returns the class implementing an engine. The libraries it depends on are only loaded by the first call for the
+    # engine, which raises `ImportError` or `OSError` if they are missing.
+    @staticmethod
+    def backend(engine):
+        if engine not in _backends:
+            if engine is Engines.POCKET_SPHINX:
+                res = PocketSphinxEngine
+            elif engine is Engines.PORCUPINE:
+                res = PorcupineEngine
+            elif engine is Engines.SNOWBOY:
+                res = SnowboyEngine
+            else:
+                matches = [x for x in _entry_points() if x.name == engine.value]
+                if len(matches) == 0:
+                    raise ValueError("cannot create engine of type '%s'" % engine.value)
+                res = matches[0].load()
+
+            res.load()
+            _backends[engine] = res
+
+        return _backends[engine]
+
+    # Makes `engine_class` the implementation of `engine`, e.g. for an engine that is neither built in nor installed.
+    @staticmethod
+    def register(engine, engine_class):
+        engine_class.load()
+        _backends[engine] = engine_class
 
     @staticmethod
     def create(engine, keyword, sensitivity, **kwargs):
-        if engine is Engines.POCKET_SPHINX:
-            return PocketSphinxEngine(keyword, sensitivity)
-        elif engine is Engines.PORCUPINE:
-            return PorcupineEngine(keyword, sensitivity, **kwargs)
-        elif engine is Engines.SNOWBOY:
-            return SnowboyEngine(keyword, sensitivity)
-        else:
-            ValueError("cannot create engine of type '%s'", engine.value)
+        engine_class = Engine.backend(engine)
+
+        start_ns = time.perf_counter_ns()
+        res = engine_class(keyword, sensitivity, **kwargs)
+        res._init_time_ns = time.perf_counter_ns() - start_ns
+
+        return res
+
+
+_backends = dict()
+
+
+# Detectors that finished a pass, kept per engine and keyword so that later passes of the process reuse them instead of
+# loading the model again. A detector of another keyword is reused if its engine can switch keywords, as PocketSphinx
+# can. Detectors of engines that cannot be reset or have their sensitivity changed are released and created anew.
+# Beyond `max_detectors`, the detectors that have been idle the longest are released. A reused detector keeps reporting
+# the initialization time of its construction.
+class DetectorPool(object):
+    def __init__(self, max_detectors=16):
+        self._max_detectors = max_detectors
+        self._detectors = list()
+
+    def acquire(self, engine, keyword, sensitivity, **kwargs):
+        for i in reversed(range(len(self._detectors))):
+            if self._detectors[i][:2] != (engine, keyword):
+                continue
+
+            detector = self._detectors.pop(i)[2]
+            try:
+                detector.set_sensitivity(sensitivity)
+                detector.reset()
+                return detector
+            except NotImplementedError:
+                detector.release()
+
+        # A detector of another keyword is only reused if the engine can switch keywords. Otherwise it stays in the
+        # pool for its own keyword.
+        for i in reversed(range(len(self._detectors))):
+            if self._detectors[i][0] != engine:
+                continue
+
+            try:
+                self._detectors[i][2].set_keyword(keyword, sensitivity)
+            except NotImplementedError:
+                continue
+            detector = self._detectors.pop(i)[2]
+            detector.reset()
+            return detector
+
+        return Engine.create(engine, keyword, sensitivity, **kwargs)
+
+    def release(self, engine, keyword, detector):
+        try:
+            detector.reset()
+        except NotImplementedError:
+            detector.release()
+            return
+
+        self._detectors.append((engine, keyword, detector))
+        while len(self._detectors) > self._max_detectors:
+            self._detectors.pop(0)[2].release()
 
 
 class PocketSphinxEngine(Engine):
-    def __init__(self, keyword, sensitivity):
-        config = Config()
+    def __init__(self, keyword, sensitivity, **kwargs):
+        super(PocketSphinxEngine, self).__init__()
+
+        pocketsphinx = self.load()
+
+        config = pocketsphinx.Config()
         config.set_string('-logfn', '/dev/null')
-        config.set_string('-hmm', os.path.join(get_model_path('en-us'), 'en-us'))
-        config.set_string('-dict', os.path.join(get_model_path('en-us'), 'cmudict-en-us.dict'))
+        config.set_string('-hmm', os.path.join(pocketsphinx.get_model_path('en-us'), 'en-us'))
+        config.set_string('-dict', os.path.join(pocketsphinx.get_model_path('en-us'), 'cmudict-en-us.dict'))
         config.set_string('-lm', None)
-        config.set_string('-keyphrase', keyword if keyword != 'snowboy' else 'snow boy')
+        config.set_string('-keyphrase', self._keyphrase(keyword))
         config.set_float('-kws_threshold', 10 ** -sensitivity)
 
-        self._decoder = Decoder(config)
+        self._keyword = keyword
+        self._decoder = pocketsphinx.Decoder(config)
+        self._cmn = self._decoder.get_cmn()
         self._decoder.start_utt()
 
-    def process(self, pcm):
-        assert pcm.dtype == np.int16
+    @staticmethod
+    def load():
+        import pocketsphinx
+        return pocketsphinx
+
+    @staticmethod
+    def _keyphrase(keyword):
+        return keyword if keyword != 'snowboy' else 'snow boy'
+
+    def set_sensitivity(self, sensitivity):
+        self.set_keyword(self._keyword, sensitivity)
 
-        self._decoder.process_raw(pcm.tobytes(), False, False)
+    # The keyphrase search takes its threshold from the configuration when it is added, hence a new one is added and
+    # activated in place of the current one. Replacing the active search itself crashes the decoder.
+    def set_keyword(self, keyword, sensitivity):
+        search = '%s_%f' % (keyword, sensitivity)
+        previous_search = self._decoder.current_search()
+        if search == previous_search:
+            return
+
+        self._decoder.end_utt()
+        self._decoder.config.set_float('-kws_threshold', 10 ** -sensitivity)
+        self._decoder.add_keyphrase(search, self._keyphrase(keyword))
+        self._decoder.activate_search(search)
+        self._decoder.remove_search(previous_search)
+        self._decoder.start_utt()
+
+        self._keyword = keyword
+
+    def _frames(self, pcm):
+        data = memoryview(pcm.tobytes())
+        frame_size = self.frame_length() * pcm.itemsize
+
+        return [data[i:(i + frame_size)] for i in range(0, len(data), frame_size)]
+
+    def _process(self, frame):
+        self._decoder.process_raw(frame, False, False)
 
         detected = self._decoder.hyp()
         if detected:
@@ -100,6 +327,12 @@ class PocketSphinxEngine(Engine):
 
         return detected
 
+    # The cepstral mean adapts to the audio at the end of every utterance and is put back to the initial one.
+    def _reset(self):
+        self._decoder.end_utt()
+        self._decoder.set_cmn(self._cmn)
+        self._decoder.start_utt()
+
     def release(self):
         self._decoder.end_utt()
 
@@ -109,15 +342,23 @@ class PocketSphinxEngine(Engine):
 
 class PorcupineEngine(Engine):
     def __init__(self, keyword, sensitivity, access_key):
-        self._porcupine = pvporcupine.create(
+        super(PorcupineEngine, self).__init__()
+
+        self._porcupine = self.load().create(
             access_key=access_key,
             keywords=[keyword.lower()],
             sensitivities=[sensitivity])
 
-    def process(self, pcm):
-        assert pcm.dtype == np.int16
+    @staticmethod
+    def load():
+        import pvporcupine
+        return pvporcupine
+
+    def _frames(self, pcm):
+        return pcm.reshape((-1, self.frame_length())).tolist()
 
-        return self._porcupine.process(pcm) == 0
+    def _process(self, frame):
+        return self._porcupine.process(frame) == 0
 
     def release(self):
         self._porcupine.delete()
@@ -127,7 +368,9 @@ class PorcupineEngine(Engine):
 
 
 class SnowboyEngine(Engine):
-    def __init__(self, keyword, sensitivity):
+    def __init__(self, keyword, sensitivity, **kwargs):
+        super(SnowboyEngine, self).__init__()
+
         keyword = keyword.lower()
         if keyword == 'alexa':
             model_relative_path = 'engines/snowboy/resources/alexa/alexa-avs-sample-app/alexa.umdl'
@@ -136,24 +379,39 @@ class SnowboyEngine(Engine):
 
         model_str = os.path.join(os.path.dirname(__file__), model_relative_path).encode()
         resource_filename = os.path.join(os.path.dirname(__file__), 'engines/snowboy/resources/common.res').encode()
-        self._snowboy = snowboydetect.SnowboyDetect(resource_filename=resource_filename, model_str=model_str)
-
-        # https://github.com/Kitt-AI/snowboy#pretrained-universal-models
+        self._snowboy = self.load().SnowboyDetect(resource_filename=resource_filename, model_str=model_str)
 
-        if keyword == 'jarvis':
-            self._snowboy.SetSensitivity(('%f,%f' % (sensitivity, sensitivity)).encode())
-        else:
-            self._snowboy.SetSensitivity(str(sensitivity).encode())
+        self._keyword = keyword
+        self.set_sensitivity(sensitivity)
 
         if keyword in {'alexa', 'computer', 'jarvis', 'view glass'}:
             self._snowboy.ApplyFrontend(True)
         else:
             self._snowboy.ApplyFrontend(False)
 
-    def process(self, pcm):
-        assert pcm.dtype == np.int16
+    @staticmethod
+    def load():
+        from engines import snowboydetect
+        return snowboydetect
+
+    # https://github.com/Kitt-AI/snowboy#pretrained-universal-models
+    def set_sensitivity(self, sensitivity):
+        if self._keyword == 'jarvis':
+            self._snowboy.SetSensitivity(('%f,%f' % (sensitivity, sensitivity)).encode())
+        else:
+            self._snowboy.SetSensitivity(str(sensitivity).encode())
+
+    def _frames(self, pcm):
+        data = pcm.tobytes()
+        frame_size = self.frame_length() * pcm.itemsize
+
+        return [data[i:(i + frame_size)] for i in range(0, len(data), frame_size)]
+
+    def _process(self, frame):
+        return self._snowboy.RunDetection(frame) == 1
 
-        return self._snowboy.RunDetection(pcm.tobytes()) == 1
+    def _reset(self):
+        self._snowboy.Reset()
 
     def release(self):
         pass
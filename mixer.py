@@ -14,87 +14,200 @@
 # limitations under the License.
 #
 
+import os
+from collections import namedtuple
+
 import numpy as np
 import soundfile
 
 from dataset import Dataset
 from engine import Engine
 
-_random = np.random.RandomState(seed=778)
+SEED = 778
 
+_random = np.random.RandomState(seed=SEED)
 
-def _pcm_energy(pcm):
+
+class _Part(namedtuple('_Part', 'dataset, index, length, silent')):
+    def load(self):
+        if self.silent:
+            return np.zeros((self.length,), dtype=np.float32)
+
+        return self.dataset.get_normalized(self.index)
+
+
+def _frame_energies(pcm):
     frame_length = Engine.frame_length()
     num_frames = pcm.size // frame_length
 
     pcm_frames = pcm[:(num_frames * frame_length)].reshape((num_frames, frame_length))
-    frames_power = (pcm_frames ** 2).sum(axis=1)
-
-    return frames_power.max()
 
+    return (pcm_frames ** 2).sum(axis=1)
 
-def _speech_scale(speech, noise, snr_db):
-    assert speech.shape[0] == noise.shape[0]
 
-    speech_energy = _pcm_energy(speech)
-    if speech_energy == 0:
-        return 0
-
-    return np.sqrt((_pcm_energy(noise) * (10 ** (snr_db / 10))) / speech_energy)
+def _pcm_energy(pcm):
+    return _frame_energies(pcm).max()
 
 
 def _max_abs(x):
     return max(np.max(x), np.abs(np.min(x)))
 
 
-def _mix_noise(speech_parts, noise_dataset, snr_db):
-    speech_length = sum(len(x) for x in speech_parts)
+class BackgroundTimeline(object):
+    def __init__(self, background_dataset, background_probability=0.2):
+        self._background_dataset = background_dataset
+        self._background_probability = background_probability
+        self._parts = list()
 
-    parts = list()
-    while sum(x.size for x in parts) < speech_length:
-        x = noise_dataset.random(dtype=np.float32)
-        parts.append(x / _max_abs(x))
+    def part(self, index):
+        while len(self._parts) <= index:
+            dataset_index = self._background_dataset.random_index()
+            silent = _random.uniform() >= self._background_probability
+            self._parts.append(
+                _Part(self._background_dataset, dataset_index, self._background_dataset.length(dataset_index), silent))
 
-    res = np.concatenate(parts)[:speech_length]
+        return self._parts[index]
 
-    start_index = 0
-    for speech_part in speech_parts:
-        end_index = start_index + len(speech_part)
-        res[start_index:end_index] += speech_part * _speech_scale(speech_part, res[start_index:end_index], snr_db)
-        start_index = end_index
 
-    return res
+# All noise files normalized and concatenated once, along with the power of each of their frames. Frames start at the
+# beginning of each file.
+class NoiseBank(object):
+    def __init__(self, noise_dataset):
+        pcms = [noise_dataset.get_normalized(i) for i in range(noise_dataset.size())]
+
+        self.pcm = np.concatenate(pcms)
+        self.lengths = np.array([x.size for x in pcms], dtype=np.int64)
+        self.offsets = np.concatenate(([0], np.cumsum(self.lengths)))
+
+        self.frame_energies = np.concatenate([_frame_energies(x) for x in pcms])
+        self.frame_offsets = np.concatenate(([0], np.cumsum(self.lengths // Engine.frame_length())))
+
+    # Maximum frame power within each of the bank ranges `[starts, ends)`, only counting frames that lie entirely inside
+    # a range. It is zero for ranges that contain no whole frame.
+    def max_energies(self, starts, ends):
+        frame_length = Engine.frame_length()
+
+        files = np.searchsorted(self.offsets, starts, side='right') - 1
+        first_frames = self.frame_offsets[files] + -((self.offsets[files] - starts) // frame_length)
+        end_frames = self.frame_offsets[files] + (ends - self.offsets[files]) // frame_length
+        # A range that starts within the partial last frame of the last file would otherwise start beyond the frames.
+        first_frames = np.minimum(first_frames, end_frames)
+
+        energies = np.append(self.frame_energies, np.float32(0))
+        indices = np.stack((first_frames, end_frames), axis=1).flatten()
+        res = np.maximum.reduceat(energies, indices)[::2]
+        res[first_frames >= end_frames] = 0
+
+        return res
+
+
+class NoiseTimeline(object):
+    def __init__(self, noise_dataset):
+        self.noise_dataset = noise_dataset
+        self._indices = list()
+        self._bank = None
+
+    def index(self, index):
+        while len(self._indices) <= index:
+            self._indices.append(self.noise_dataset.random_index())
+
+        return self._indices[index]
+
+    def bank(self):
+        if self._bank is None:
+            self._bank = NoiseBank(self.noise_dataset)
+
+        return self._bank
+
+
+# The noise underneath a sequence of parts. The noise files of the timeline are laid end to end and each part takes the
+# next `length` samples. Where a part spans several files, it is made of several ranges of the bank. The noise energy of
+# every part is computed upfront from the frame powers of the bank.
+class _NoiseTrack(object):
+    def __init__(self, noise_timeline, lengths):
+        self._bank = noise_timeline.bank()
+
+        part_offsets = np.concatenate(([0], np.cumsum(lengths, dtype=np.int64)))
+        length = part_offsets[-1]
+
+        indices = list()
+        indices_length = 0
+        while indices_length < length:
+            indices.append(noise_timeline.index(len(indices)))
+            indices_length += self._bank.lengths[indices[-1]]
+        indices = np.array(indices, dtype=np.int64)
+        file_offsets = np.concatenate(([0], np.cumsum(self._bank.lengths[indices])))
 
+        boundaries = np.union1d(part_offsets, file_offsets[file_offsets < length])
+        starts = boundaries[:-1]
+        files = np.searchsorted(file_offsets, starts, side='right') - 1
 
-def _assemble_background(background_dataset, length_samples, background_probability=0.2):
+        self._starts = self._bank.offsets[indices[files]] + starts - file_offsets[files]
+        self._ends = self._starts + np.diff(boundaries)
+        self._part_ranges = np.searchsorted(starts, part_offsets)
+
+        self.energies = np.zeros((len(lengths),), dtype=np.float32)
+        np.maximum.at(
+            self.energies,
+            np.searchsorted(part_offsets, starts, side='right') - 1,
+            self._bank.max_energies(self._starts, self._ends))
+
+    def part(self, index):
+        ranges = range(self._part_ranges[index], self._part_ranges[index + 1])
+
+        return np.concatenate([self._bank.pcm[self._starts[i]:self._ends[i]] for i in ranges])
+
+
+def _mix_noise(speech_parts, noise_timeline, snr_db):
+    noise_track = _NoiseTrack(noise_timeline, [x.length for x in speech_parts])
+
+    for i, speech_part in enumerate(speech_parts):
+        res = noise_track.part(i)
+        if speech_part.silent:
+            yield res
+            continue
+
+        speech = speech_part.load()
+        scale = _snr_scales(np.array([_pcm_energy(speech)]), noise_track.energies[i:(i + 1)], snr_db)[0]
+        res += speech * scale
+
+        yield res
+
+
+def _assemble_background(background_timeline, start_index, length_samples):
     parts = list()
-    while sum(x.size for x in parts) < length_samples:
-        x = background_dataset.random(dtype=np.float32)
-        if _random.uniform() < background_probability:
-            parts.append(x / _max_abs(x))
-        else:
-            parts.append(np.zeros((x.size,), dtype=np.float32))
+    parts_length = 0
+    while parts_length < length_samples:
+        parts.append(background_timeline.part(start_index + len(parts)))
+        parts_length += parts[-1].length
 
-    return parts
+    return parts, parts_length
 
 
-def _assemble_speech(keyword_dataset, background_dataset, length_hour):
+def _assemble_speech(keyword_dataset, background_timeline, length_hour):
     num_keywords = keyword_dataset.size()
     keyword_indices = _random.permutation(np.arange(num_keywords))
 
     background_length_samples = (length_hour * 3600 * Dataset.sample_rate()) // (num_keywords + 1)
 
-    parts = _assemble_background(background_dataset, background_length_samples)
+    parts, offset = _assemble_background(background_timeline, 0, background_length_samples)
+    num_background_parts = len(parts)
     keyword_times_sec = list()
     for keyword_index in keyword_indices:
-        keyword_part = keyword_dataset.get(keyword_index, dtype=np.float32)
+        keyword_length = keyword_dataset.length(keyword_index)
 
-        start_time_sec = sum(x.size for x in parts) / Dataset.sample_rate()
-        end_time_sec = start_time_sec + (keyword_part.size / Dataset.sample_rate()) + 0.5
+        start_time_sec = offset / Dataset.sample_rate()
+        end_time_sec = start_time_sec + (keyword_length / Dataset.sample_rate())
         keyword_times_sec.append((start_time_sec, end_time_sec))
 
-        parts.append(keyword_part / _max_abs(keyword_part))
-        parts.extend(_assemble_background(background_dataset, background_length_samples))
+        parts.append(_Part(keyword_dataset, keyword_index, keyword_length, False))
+        offset += keyword_length
+
+        background_parts, background_length = \
+            _assemble_background(background_timeline, num_background_parts, background_length_samples)
+        parts.extend(background_parts)
+        num_background_parts += len(background_parts)
+        offset += background_length
 
     return parts, keyword_times_sec
 
@@ -106,13 +219,139 @@ def create_test_files(
         background_dataset,
         noise_dataset,
         length_hour=24,
-        snr_db=10):
-    speech_parts, keyword_times_sec = _assemble_speech(keyword_dataset, background_dataset, length_hour)
-    speech = _mix_noise(speech_parts, noise_dataset, snr_db)
-    speech /= _max_abs(speech)
-
-    soundfile.write(speech_path, speech, samplerate=Dataset.sample_rate())
-
+        snr_db=10,
+        block_length=Dataset.sample_rate() * 60,
+        background_timeline=None,
+        noise_timeline=None):
+    if background_timeline is None:
+        background_timeline = BackgroundTimeline(background_dataset)
+    if noise_timeline is None:
+        noise_timeline = NoiseTimeline(noise_dataset)
+
+    speech_parts, keyword_times_sec = _assemble_speech(keyword_dataset, background_timeline, length_hour)
+
+    # The peak used for normalization is only known once everything is mixed. Hence, the unnormalized mix is spilled to
+    # disk and normalized in a second pass.
+    unnormalized_path = '%s.f32' % os.path.splitext(speech_path)[0]
+    try:
+        max_abs = 0
+        with open(unnormalized_path, 'wb') as f:
+            for x in _mix_noise(speech_parts, noise_timeline, snr_db):
+                max_abs = max(max_abs, _max_abs(x))
+                x.tofile(f)
+
+        unnormalized = np.memmap(unnormalized_path, dtype=np.float32, mode='r')
+        with soundfile.SoundFile(speech_path, 'w', samplerate=Dataset.sample_rate(), channels=1) as f:
+            for start_index in range(0, unnormalized.size, block_length):
+                f.write(unnormalized[start_index:(start_index + block_length)] / max_abs)
+        del unnormalized
+    finally:
+        if os.path.exists(unnormalized_path):
+            os.remove(unnormalized_path)
+
+    _write_labels(label_path, keyword_times_sec)
+
+
+def _write_labels(label_path, keyword_times_sec):
     with open(label_path, 'w') as f:
         for start_sec, end_sec in keyword_times_sec:
             f.write('%.2f, %.2f\n' % (start_sec, end_sec))
+
+
+def _snr_scales(speech_energies, noise_energies, snr_db):
+    res = np.zeros(speech_energies.shape, dtype=np.float32)
+    non_silent = speech_energies != 0
+    res[non_silent] = np.sqrt(
+        (noise_energies[non_silent] * np.float32(10 ** (snr_db / 10))) / speech_energies[non_silent])
+
+    return res
+
+
+def snr_sweep_paths(sweep_path):
+    return '%s_speech.f32' % sweep_path, '%s_noise.f32' % sweep_path, '%s_parts.npz' % sweep_path
+
+
+# Instead of a test file per SNR, the normalized speech and the noise bed are stored as separate tracks along with the
+# energy of each part. Any of `snr_dbs` can then be mixed on the fly by `MixedSpeech`.
+def create_snr_sweep_files(
+        sweep_path,
+        label_path,
+        keyword_dataset,
+        background_dataset,
+        noise_dataset,
+        snr_dbs,
+        length_hour=24,
+        background_timeline=None,
+        noise_timeline=None):
+    if background_timeline is None:
+        background_timeline = BackgroundTimeline(background_dataset)
+    if noise_timeline is None:
+        noise_timeline = NoiseTimeline(noise_dataset)
+
+    speech_parts, keyword_times_sec = _assemble_speech(keyword_dataset, background_timeline, length_hour)
+
+    speech_path, noise_path, parts_path = snr_sweep_paths(sweep_path)
+
+    noise_track = _NoiseTrack(noise_timeline, [x.length for x in speech_parts])
+    offsets = [0]
+    speech_energies = list()
+    max_abs = [np.float32(0)] * len(snr_dbs)
+    with open(speech_path, 'wb') as speech_f, open(noise_path, 'wb') as noise_f:
+        for i, speech_part in enumerate(speech_parts):
+            speech = speech_part.load()
+            noise = noise_track.part(i)
+
+            speech_energies.append(_pcm_energy(speech))
+            for j, snr_db in enumerate(snr_dbs):
+                scale = _snr_scales(np.array(speech_energies[-1:]), noise_track.energies[i:(i + 1)], snr_db)[0]
+                max_abs[j] = max(max_abs[j], _max_abs(noise + speech * scale))
+
+            speech.astype(np.float32).tofile(speech_f)
+            noise.tofile(noise_f)
+            offsets.append(offsets[-1] + speech.size)
+
+    np.savez(
+        parts_path,
+        offsets=np.array(offsets, dtype=np.int64),
+        speech_energies=np.array(speech_energies, dtype=np.float32),
+        noise_energies=noise_track.energies,
+        snr_dbs=np.array(snr_dbs, dtype=np.float64),
+        max_abs=np.array(max_abs, dtype=np.float32))
+
+    _write_labels(label_path, keyword_times_sec)
+
+
+# Same conversion as libsndfile applies when writing floats to a 16-bit file: to 32 bits with rounding, then the lower
+# 16 bits are dropped.
+def _to_int16(pcm):
+    return np.clip(np.rint(pcm * np.float32(2 ** 31)).astype(np.int64) >> 16, -32768, 32767).astype(np.int16)
+
+
+# Read-only view of the test audio at one of the SNRs of files created by `create_snr_sweep_files`. Slicing it yields
+# the same 16-bit samples as the WAV that `create_test_files` writes for that SNR.
+class MixedSpeech(object):
+    def __init__(self, sweep_path, snr_db):
+        speech_path, noise_path, parts_path = snr_sweep_paths(sweep_path)
+
+        with np.load(parts_path) as x:
+            snr_index = list(x['snr_dbs']).index(snr_db)
+            self._offsets = x['offsets']
+            self._scales = _snr_scales(x['speech_energies'], x['noise_energies'], snr_db)
+            self._max_abs = x['max_abs'][snr_index]
+
+        self._speech = np.memmap(speech_path, dtype=np.float32, mode='r')
+        self._noise = np.memmap(noise_path, dtype=np.float32, mode='r')
+        self.size = self._speech.size
+
+    def __getitem__(self, key):
+        start, stop, _ = key.indices(self.size)
+        stop = max(start, stop)
+
+        first = np.searchsorted(self._offsets, start, side='right') - 1
+        last = np.searchsorted(self._offsets, stop, side='left')
+        boundaries = np.clip(self._offsets[first:(last + 1)], start, stop)
+        scales = np.repeat(self._scales[first:last], np.diff(boundaries))
+
+        res = (self._noise[start:stop] + self._speech[start:stop] * scales) / self._max_abs
+
+        return _to_int16(res)
@@ -1,9 +1,11 @@
+import argparse
 import os
 
 import matplotlib.pyplot as plt
 import numpy as np
 
 from engine import Engines
+from results import ResultStore
 
 KEYWORDS = {'alexa', 'computer', 'jarvis', 'smart mirror', 'snowboy', 'view glass'}
 
@@ -26,25 +28,22 @@ COLOR = (119 / 255, 131 / 255, 143 / 255)
 PV_COLOR = (55 / 255, 125 / 255, 255 / 255)
 
 
-def plot_accuracy_chart(target_false_alarm_per_hour=0.1):
+# Raises `ValueError` naming the engines and keywords that `results` lack, as a plot needs all of them.
+def _check_complete(results, snr_db):
+    missing = ["%s '%s'" % (e.value, k) for e in Engines for k in sorted(KEYWORDS) if (e.value, k) not in results]
+    if len(missing) > 0:
+        raise ValueError('there are no results at %s dB SNR for %s' % (snr_db, ', '.join(missing)))
+
+
+def plot_accuracy_chart(store, run_ids=None, snr_db=10, target_false_alarm_per_hour=0.1):
     engine_miss_rates = dict([(x.value, 0) for x in Engines])
 
+    miss_rates_at_target = store.miss_rates_at(target_false_alarm_per_hour, snr_db, run_ids)
+    _check_complete(miss_rates_at_target, snr_db)
     for keyword in KEYWORDS:
         for engine in Engines:
             engine = engine.value
-
-            with open(os.path.join(os.path.dirname(__file__), '%s_%s.csv' % (keyword, engine)), 'r') as f:
-                miss_rates = list()
-                false_alarms_per_hour = list()
-                for line in f.readlines():
-                    miss_rate, false_alarm = [float(x) for x in line.strip('\n').split(', ')]
-                    if len(false_alarms_per_hour) > 0 and false_alarms_per_hour[-1] == false_alarm:
-                        miss_rates[-1] = miss_rate
-                    else:
-                        miss_rates.append(miss_rate)
-                        false_alarms_per_hour.append(false_alarm)
-                engine_miss_rates[engine] += \
-                    np.interp(target_false_alarm_per_hour, false_alarms_per_hour, miss_rates) / len(KEYWORDS)
+            engine_miss_rates[engine] += miss_rates_at_target[engine, keyword] / len(KEYWORDS)
 
     engine_miss_rates = sorted(engine_miss_rates.items(), key=lambda x: x[1], reverse=True)
     engines = [x[0] for x in engine_miss_rates]
@@ -81,18 +80,22 @@ def plot_accuracy_chart(target_false_alarm_per_hour=0.1):
     plt.show()
 
 
-def plot_cpu_chart():
+def plot_cpu_chart(store, run_ids=None, snr_db=10):
+    results = store.latest(run_ids, with_runtime=True, snr_db=snr_db)
+    _check_complete(set(results[['engine', 'keyword']].tolist()), snr_db)
+
     fig, ax = plt.subplots()
 
     for spine in plt.gca().spines.values():
         if spine.spine_type != 'bottom':
             spine.set_visible(False)
 
-    engine_cpu_usage = [
-        (Engines.POCKET_SPHINX.value, 12.13),
-        (Engines.SNOWBOY.value, 3.84),
-        (Engines.PORCUPINE.value, 0.60)
-    ]
+    engine_cpu_usage = list()
+    for engine in Engines:
+        engine_results = results[results['engine'] == engine.value]
+        real_time_factors = engine_results['real_time_factor'][np.isin(engine_results['keyword'], list(KEYWORDS))]
+        engine_cpu_usage.append((engine.value, np.mean(real_time_factors) * 100))
+    engine_cpu_usage.sort(key=lambda x: x[1], reverse=True)
 
     engines = [x[0] for x in engine_cpu_usage]
     cpu_usages = [x[1] for x in engine_cpu_usage]
@@ -113,7 +116,7 @@ def plot_cpu_chart():
             color=PV_COLOR if engines[i] == Engines.PORCUPINE.value else COLOR)
 
     ax.set_ylim(0, max(cpu_usages) + 10)
-    ax.set_title('CPU usage on Raspberry Pi 5 32-bit')
+    ax.set_title('CPU usage')
     ax.set_xticks(indices)
     ax.set_xticklabels(engines)
     plt.tick_params(axis='y', which='both', left=False, right=False, labelleft=False)
@@ -123,6 +126,20 @@ def plot_cpu_chart():
 
 
 if __name__ == '__main__':
-    plot_accuracy_chart()
-
-    plot_cpu_chart()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--results-path', default=os.path.join(os.path.dirname(__file__), 'results.db'))
+    parser.add_argument(
+        '--run-id',
+        nargs='+',
+        help='runs to plot, all by default; each engine and keyword is plotted from the latest of them that has it')
+    parser.add_argument('--snr-db', type=float, default=10)
+    args = parser.parse_args()
+
+    result_store = ResultStore(args.results_path)
+
+    try:
+        plot_accuracy_chart(result_store, args.run_id, args.snr_db)
+
+        plot_cpu_chart(result_store, args.run_id, args.snr_db)
+    except ValueError as e:
+        parser.error(str(e))
@@ -0,0 +1,129 @@
+#
+# Copyright 2018 Picovoice Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import sqlite3
+import time
+
+import numpy as np
+
+from engine import RuntimeInfo
+
+_KEY_COLUMNS = ('run_id', 'engine', 'keyword', 'snr_db', 'sensitivity')
+
+_COLUMNS = \
+    _KEY_COLUMNS + \
+    ('miss_rate', 'false_alarm_per_hour', 'num_extra_detections') + \
+    RuntimeInfo._fields + \
+    ('detection_mean_ms', 'detection_p50_ms', 'detection_p95_ms')
+
+_TEXT_COLUMNS = {'run_id', 'engine', 'keyword'}
+
+
+def new_run_id():
+    return time.strftime('%Y%m%d-%H%M%S')
+
+
+# Results of all runs in one SQLite database. There is a row per run, engine, keyword, SNR and sensitivity. Queries
+# return numpy structured arrays with a field per column.
+class ResultStore(object):
+    def __init__(self, path):
+        self._connection = sqlite3.connect(path)
+
+        columns = ', '.join('%s %s' % (x, 'TEXT' if x in _TEXT_COLUMNS else 'REAL') for x in _COLUMNS)
+        with self._connection:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS results (%s, PRIMARY KEY (%s))' % (columns, ', '.join(_KEY_COLUMNS)))
+            self._connection.execute('CREATE TABLE IF NOT EXISTS runs (run_id TEXT PRIMARY KEY, created REAL)')
+
+    def close(self):
+        self._connection.close()
+
+    def insert(self, run_id, engine, keyword, snr_db, result):
+        rows = list()
+        for sensitivity, x in result.items():
+            miss_rate, false_alarm_per_hour, runtime_info, latency, num_extra_detections = x
+            if runtime_info is None:
+                runtime_info = (None,) * len(RuntimeInfo._fields)
+
+            rows.append(
+                (run_id, engine, keyword, snr_db, sensitivity, miss_rate, false_alarm_per_hour, num_extra_detections) +
+                tuple(runtime_info) +
+                tuple(latency))
+
+        with self._connection:
+            self._connection.execute('INSERT OR IGNORE INTO runs VALUES (?, ?)', (run_id, time.time()))
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO results VALUES (%s)' % ', '.join('?' * len(_COLUMNS)),
+                [tuple(float(x) if isinstance(x, np.number) else x for x in row) for row in rows])
+
+    def runs(self):
+        return [x[0] for x in self._connection.execute('SELECT run_id FROM runs ORDER BY created')]
+
+    def query(self, **kwargs):
+        assert all(x in _KEY_COLUMNS for x in kwargs.keys())
+
+        where = ' AND '.join('%s = ?' % x for x in kwargs.keys())
+        rows = self._connection.execute(
+            'SELECT * FROM results %s ORDER BY %s' % (('WHERE %s' % where) if where else '', ', '.join(_KEY_COLUMNS)),
+            tuple(kwargs.values())).fetchall()
+
+        return self._array(rows)
+
+    # Results of each engine, keyword and SNR from the latest of `run_ids` (all runs by default) that has them, so that
+    # runs that each cover some of the engines and keywords are combined. Sensitivities of different runs are not mixed.
+    # With `with_runtime`, runs without runtime measurements, such as those recomputed from traces, are skipped.
+    def latest(self, run_ids=None, with_runtime=False, **kwargs):
+        assert all(x in _KEY_COLUMNS[1:] for x in kwargs.keys())
+
+        where = ['%s = ?' % x for x in kwargs.keys()]
+        values = list(kwargs.values())
+        if with_runtime:
+            where.append('real_time_factor IS NOT NULL')
+        if run_ids is not None:
+            where.append('run_id IN (%s)' % ', '.join('?' * len(run_ids)))
+            values.extend(run_ids)
+        rows = self._connection.execute(
+            'SELECT results.* FROM results JOIN runs USING (run_id) %s ORDER BY runs.created' %
+            (('WHERE %s' % ' AND '.join(where)) if where else ''),
+            tuple(values)).fetchall()
+
+        latest_run_ids = dict((x[1:4], x[0]) for x in rows)
+        return self._array(sorted((x for x in rows if latest_run_ids[x[1:4]] == x[0]), key=lambda x: x[1:5]))
+
+    @staticmethod
+    def _array(rows):
+        dtype = [(x, object if x in _TEXT_COLUMNS else np.float64) for x in _COLUMNS]
+        return np.array([tuple(np.nan if y is None else y for y in x) for x in rows], dtype=dtype)
+
+    # Miss rate of each (engine, keyword) at `false_alarm_per_hour`, linearly interpolated between sensitivities, from
+    # the latest of `run_ids` that has the engine and keyword.
+    def miss_rates_at(self, false_alarm_per_hour, snr_db, run_ids=None):
+        results = self.latest(run_ids, snr_db=snr_db)
+
+        groups = results[['engine', 'keyword']].tolist()
+        boundaries = [i for i in range(1, len(groups)) if groups[i] != groups[i - 1]]
+
+        res = dict()
+        for x in np.split(results, boundaries):
+            if x.size == 0:
+                continue
+
+            # Where consecutive sensitivities have the same false alarm rate, only the highest of them is kept.
+            keep = np.append(x['false_alarm_per_hour'][1:] != x['false_alarm_per_hour'][:-1], True)
+            res[x['engine'][0], x['keyword'][0]] = np.interp(
+                false_alarm_per_hour, x['false_alarm_per_hour'][keep], x['miss_rate'][keep])
+
+        return res
@@ -0,0 +1,296 @@
+#
+# Copyright 2018 Picovoice Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import itertools
+import queue
+
+from engine import Engine
+
+
+def sensitivity_grid(engine_type):
+    sensitivity_info = Engine.sensitivity_info(engine_type)
+
+    down = list()
+    sensitivity = (sensitivity_info.min + sensitivity_info.max) / 2
+    while sensitivity >= sensitivity_info.min:
+        down.append(sensitivity)
+        sensitivity -= sensitivity_info.step
+
+    up = list()
+    sensitivity = (sensitivity_info.min + sensitivity_info.max) / 2 + sensitivity_info.step
+    while sensitivity <= sensitivity_info.max:
+        up.append(sensitivity)
+        sensitivity += sensitivity_info.step
+
+    return down, up
+
+
+class Sweep(object):
+    def __init__(self, engine_type, keyword, snr_db=None):
+        self.engine_type = engine_type
+        self.keyword = keyword
+        self.snr_db = snr_db
+
+    def next(self):
+        raise NotImplementedError()
+
+    def update(self, result):
+        raise NotImplementedError()
+
+    def done(self):
+        raise NotImplementedError()
+
+    def results(self):
+        raise NotImplementedError()
+
+
+class GridSweep(Sweep):
+    def __init__(self, engine_type, keyword, snr_db=None):
+        super(GridSweep, self).__init__(engine_type, keyword, snr_db)
+
+        down, up = sensitivity_grid(engine_type)
+        self._sensitivities = down + up
+        self._submitted = False
+        self._res = None
+
+    def next(self):
+        if self._submitted:
+            return None
+
+        self._submitted = True
+        return self._sensitivities
+
+    def update(self, result):
+        self._res = result
+
+    def done(self):
+        return self._res is not None
+
+    def results(self):
+        return self._res
+
+
+# Walks down from the middle of the sensitivity range until the false alarm rate drops to `min_false_alarm` and up until
+# it reaches `max_false_alarm`. Both directions are evaluated concurrently, one sensitivity per task. Each direction
+# runs at most `max_speculation` points past the points walked so far, so that few passes are spent beyond a stopping
+# point that is not known yet. Results of points beyond a stopping point are discarded.
+class LinearSweep(Sweep):
+    def __init__(
+            self, engine_type, keyword, snr_db=None, min_false_alarm=0.1, max_false_alarm=0.1, max_speculation=2):
+        super(LinearSweep, self).__init__(engine_type, keyword, snr_db)
+
+        self._down, self._up = sensitivity_grid(engine_type)
+        self._min_false_alarm = min_false_alarm
+        self._max_false_alarm = max_false_alarm
+        self._max_speculation = max_speculation
+
+        self._res = dict()
+        self._submitted = set()
+        self._direction = 0
+
+    def next(self):
+        candidates = [self._next_down(), self._next_up()]
+        for i in range(len(candidates)):
+            sensitivity = candidates[(self._direction + i) % len(candidates)]
+            if sensitivity is not None:
+                self._direction = (self._direction + i + 1) % len(candidates)
+                self._submitted.add(sensitivity)
+                return [sensitivity]
+
+        return None
+
+    def update(self, result):
+        self._res.update(result)
+
+    def done(self):
+        return self._next_down() is None and self._next_up() is None and self._submitted.issubset(self._res.keys())
+
+    def results(self):
+        down = self._down[:self._down_stop() + 1]
+        res = dict((x, self._res[x]) for x in down)
+
+        if max(x[1] for x in res.values()) < self._max_false_alarm:
+            res.update((x, self._res[x]) for x in self._up[:self._up_stop() + 1])
+
+        return res
+
+    def _next_down(self):
+        return self._next(self._down, self._down_stop())
+
+    def _next_up(self):
+        down_stop = self._down_stop()
+        if all(x in self._res for x in self._down[:down_stop + 1]):
+            if max(self._res[x][1] for x in self._down[:down_stop + 1]) >= self._max_false_alarm:
+                return None
+
+        return self._next(self._up, self._up_stop())
+
+    def _next(self, sensitivities, stop):
+        num_walked = 0
+        while num_walked < len(sensitivities) and sensitivities[num_walked] in self._res:
+            num_walked += 1
+
+        for sensitivity in sensitivities[:min(stop + 1, num_walked + self._max_speculation)]:
+            if sensitivity not in self._submitted:
+                return sensitivity
+
+        return None
+
+    def _down_stop(self):
+        for i, sensitivity in enumerate(self._down):
+            if sensitivity in self._res and self._res[sensitivity][1] <= self._min_false_alarm:
+                return i
+
+        return len(self._down) - 1
+
+    def _up_stop(self):
+        for i, sensitivity in enumerate(self._up):
+            if sensitivity in self._res and self._res[sensitivity][1] >= self._max_false_alarm:
+                return i
+
+        return len(self._up) - 1
+
+
+# Assumes that the false alarm rate increases with sensitivity. Walks from the middle of the sensitivity range, one
+# step at a time, towards the target false alarm rate until it is bracketed and then bisects that step until the
+# bracketing points are at most `resolution` apart. One sensitivity is evaluated at a time.
+class BisectionSweep(Sweep):
+    def __init__(self, engine_type, keyword, snr_db=None, target_false_alarm=0.1, resolution=None):
+        super(BisectionSweep, self).__init__(engine_type, keyword, snr_db)
+
+        self._down, self._up = sensitivity_grid(engine_type)
+        self._target_false_alarm = target_false_alarm
+        self._resolution = Engine.sensitivity_info(engine_type).step / 4 if resolution is None else resolution
+
+        self._res = dict()
+        self._next_sensitivity = self._down[0]
+        self._in_flight = False
+
+    def next(self):
+        if self._in_flight or self._next_sensitivity is None:
+            return None
+
+        self._in_flight = True
+        return [self._next_sensitivity]
+
+    def update(self, result):
+        self._res.update(result)
+        self._in_flight = False
+        self._next_sensitivity = self._next()
+
+    def done(self):
+        return not self._in_flight and self._next_sensitivity is None
+
+    def results(self):
+        return dict(self._res)
+
+    def _next(self):
+        below = [x for x, y in self._res.items() if y[1] <= self._target_false_alarm]
+        above = [x for x, y in self._res.items() if y[1] > self._target_false_alarm]
+        if len(below) > 0 and len(above) > 0:
+            low, high = max(below), min(above)
+            if low < high and (high - low) > self._resolution:
+                return (low + high) / 2
+            return None
+
+        for sensitivity in (self._down if len(above) > 0 else self._up):
+            if sensitivity not in self._res:
+                return sensitivity
+
+        return None
+
+
+# At most `num_processes` tasks are in flight so that sweeps decide on their next point after seeing earlier results.
+# Each task proposed by a sweep is split into `num_shards` shards whose results are combined by `merge`. Sensitivities
+# for which `finished` already returns a result (e.g. from an earlier, interrupted run) are not run again.
+class Scheduler(object):
+    def __init__(self, pool, num_processes, func, merge, num_shards=1, finished=None):
+        self._pool = pool
+        self._num_processes = num_processes
+        self._func = func
+        self._merge = merge
+        self._num_shards = num_shards
+        self._finished = finished
+
+    def run(self, sweeps):
+        completed = queue.Queue()
+
+        task_ids = itertools.count()
+        tasks = dict()
+        queued = list()
+        num_in_flight = 0
+        index = 0
+        while True:
+            while num_in_flight < self._num_processes:
+                if len(queued) == 0:
+                    proposed = False
+                    for i in range(len(sweeps)):
+                        sweep = sweeps[(index + i) % len(sweeps)]
+                        sensitivities = sweep.next()
+                        if sensitivities is not None:
+                            proposed = True
+                            index = (index + i + 1) % len(sweeps)
+
+                            finished = dict()
+                            if self._finished is not None:
+                                finished = self._finished(sweep.engine_type, sweep.keyword, sweep.snr_db, sensitivities)
+                            sensitivities = [x for x in sensitivities if x not in finished]
+
+                            if len(sensitivities) == 0:
+                                sweep.update(finished)
+                            else:
+                                task_id = next(task_ids)
+                                tasks[task_id] = sweep, sensitivities, dict(), finished
+                                queued.extend((task_id, x) for x in range(self._num_shards))
+                            break
+
+                    if not proposed:
+                        break
+
+                if len(queued) == 0:
+                    continue
+
+                task_id, shard = queued.pop(0)
+                sweep, sensitivities, _, _ = tasks[task_id]
+                self._pool.apply_async(
+                    self._func,
+                    (sweep.engine_type, sweep.keyword, sweep.snr_db, sensitivities, shard, self._num_shards),
+                    callback=lambda x, task_id=task_id, shard=shard: completed.put((task_id, shard, x, None)),
+                    error_callback=lambda e, task_id=task_id, shard=shard: completed.put((task_id, shard, None, e)))
+                num_in_flight += 1
+
+            if num_in_flight == 0:
+                break
+
+            task_id, shard, result, error = completed.get()
+            num_in_flight -= 1
+            if error is not None:
+                raise error
+
+            sweep, _, shard_results, finished = tasks[task_id]
+            shard_results[shard] = result
+            if len(shard_results) == self._num_shards:
+                del tasks[task_id]
+                finished.update(self._merge(
+                    sweep.engine_type,
+                    sweep.keyword,
+                    sweep.snr_db,
+                    [shard_results[x] for x in range(self._num_shards)]))
+                sweep.update(finished)
+
+        assert all(x.done() for x in sweeps)
+
+        return sweeps
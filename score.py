@@ -0,0 +1,187 @@
+#
+# Copyright 2018 Picovoice Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import argparse
+import glob
+import os
+from collections import namedtuple
+
+import numpy as np
+
+from dataset import Dataset
+from engine import Engine
+from results import (
+    ResultStore,
+    new_run_id
+)
+
+Trace = namedtuple('Trace', 'engine, keyword, sensitivity, detections, num_samples, keyword_times_sec, snr_db')
+
+DetectionLatency = namedtuple('DetectionLatency', 'mean_ms, p50_ms, p95_ms')
+
+
+def read_labels(path):
+    keyword_times_sec = list()
+    with open(path, 'r') as f:
+        for line in f.readlines():
+            keyword_times_sec.append(tuple(float(x) for x in line.strip('\n').split(', ')))
+
+    return np.array(keyword_times_sec, dtype=np.float64).reshape((-1, 2))
+
+
+# Frames within which a detection counts towards a keyword. The interval of a keyword starts with the frame in which the
+# keyword starts and ends (inclusively) `tolerance_sec` after it.
+KeywordIntervals = namedtuple('KeywordIntervals', 'start_frames, end_frames')
+
+
+def keyword_intervals(keyword_times_sec, tolerance_sec=0.5):
+    frame_length = Engine.frame_length()
+
+    start_frames = (keyword_times_sec[:, 0] * Dataset.sample_rate() // frame_length).astype(np.int64)
+    end_frames = (
+        ((keyword_times_sec[:, 1] + tolerance_sec) * Dataset.sample_rate() + (frame_length - 1)) // frame_length)
+
+    return KeywordIntervals(start_frames=start_frames, end_frames=end_frames.astype(np.int64))
+
+
+# Index of the keyword whose interval contains each detection or -1 for detections outside of all of them.
+def match_detections(detections, intervals):
+    res = np.searchsorted(intervals.start_frames, detections, side='right') - 1
+    res[(res >= 0) & (detections > intervals.end_frames[np.maximum(res, 0)])] = -1
+
+    return res
+
+
+# A keyword is detected if at least one detection falls within its interval. Further detections within the same interval
+# are neither counted as detections nor as false alarms but are reported as extra detections.
+def score(detections, intervals, num_samples):
+    keyword_indices = match_detections(detections, intervals)
+
+    num_matched = np.count_nonzero(keyword_indices >= 0)
+    num_true_detects = np.unique(keyword_indices[keyword_indices >= 0]).size
+    num_false_alarms = detections.size - num_matched
+
+    miss_rate = (intervals.start_frames.size - num_true_detects) / intervals.start_frames.size
+    false_alarm_per_hour = num_false_alarms / (num_samples / (Dataset.sample_rate() * 3600))
+
+    return miss_rate, false_alarm_per_hour, num_matched - num_true_detects
+
+
+# Delay from the end of each detected keyword to the end of the frame in which it was first detected. It is negative if
+# an engine fires before the keyword ends.
+def detection_latencies(detections, intervals, keyword_times_sec):
+    frame_length = Engine.frame_length()
+
+    keyword_indices = match_detections(detections, intervals)
+    true_detections = detections[keyword_indices >= 0]
+    keyword_indices, first_detections = np.unique(keyword_indices[keyword_indices >= 0], return_index=True)
+
+    detection_times_sec = (true_detections[first_detections] + 1) * frame_length / Dataset.sample_rate()
+
+    return detection_times_sec - keyword_times_sec[keyword_indices, 1]
+
+
+def detection_latency(latencies_sec):
+    if latencies_sec.size == 0:
+        return DetectionLatency(np.nan, np.nan, np.nan)
+
+    p50_ms, p95_ms = np.percentile(latencies_sec * 1e3, [50, 95])
+
+    return DetectionLatency(mean_ms=latencies_sec.mean() * 1e3, p50_ms=p50_ms, p95_ms=p95_ms)
+
+
+def result_name(keyword, engine, snr_db=None):
+    if snr_db is None:
+        return '%s_%s' % (keyword, engine)
+
+    return '%s_%s_%gdB' % (keyword, engine, snr_db)
+
+
+def trace_path(trace_dir, engine, keyword, sensitivity, snr_db=None):
+    return os.path.join(trace_dir, '%s_%f.npz' % (result_name(keyword, engine, snr_db), sensitivity))
+
+
+def save_trace(trace_dir, trace):
+    os.makedirs(trace_dir, exist_ok=True)
+
+    with open(trace_path(trace_dir, trace.engine, trace.keyword, trace.sensitivity, trace.snr_db), 'wb') as f:
+        np.savez(
+            f,
+            engine=np.array(trace.engine),
+            keyword=np.array(trace.keyword),
+            sensitivity=np.array(trace.sensitivity, dtype=np.float64),
+            detections=np.asarray(trace.detections, dtype=np.uint32),
+            num_samples=np.array(trace.num_samples, dtype=np.int64),
+            keyword_times_sec=np.asarray(trace.keyword_times_sec, dtype=np.float64),
+            snr_db=np.array(trace.snr_db, dtype=np.float64))
+
+
+def load_trace(path):
+    with np.load(path) as x:
+        return Trace(
+            engine=str(x['engine']),
+            keyword=str(x['keyword']),
+            sensitivity=float(x['sensitivity']),
+            detections=x['detections'].astype(np.int64),
+            num_samples=int(x['num_samples']),
+            keyword_times_sec=x['keyword_times_sec'],
+            snr_db=float(x['snr_db']))
+
+
+# Traces of each run are kept in a directory of their own, so that the results of a run are recomputed from its traces
+# only.
+def run_trace_dir(trace_dir, run_id):
+    return os.path.join(trace_dir, run_id)
+
+
+def rescore(trace_dir, tolerance_sec=0.5):
+    res = dict()
+    for path in glob.glob(os.path.join(trace_dir, '*.npz')):
+        trace = load_trace(path)
+        intervals = keyword_intervals(trace.keyword_times_sec, tolerance_sec)
+        miss_rate, false_alarm_per_hour, num_extra_detections = score(trace.detections, intervals, trace.num_samples)
+        latency = detection_latency(detection_latencies(trace.detections, intervals, trace.keyword_times_sec))
+        res.setdefault((trace.keyword, trace.engine, trace.snr_db), dict())[trace.sensitivity] = \
+            miss_rate, false_alarm_per_hour, None, latency, num_extra_detections
+
+    return res
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--trace-dir', default=os.path.join(os.path.dirname(__file__), 'traces'))
+    parser.add_argument('--traced-run-id', required=True, help='run whose traces are scored')
+    parser.add_argument('--tolerance-sec', type=float, default=0.5)
+
+    parser.add_argument('--results-path', default=os.path.join(os.path.dirname(__file__), 'results.db'))
+    parser.add_argument('--run-id', default=new_run_id())
+    args = parser.parse_args()
+
+    traced_run_dir = run_trace_dir(args.trace_dir, args.traced_run_id)
+    if not os.path.isdir(traced_run_dir):
+        parser.error("there are no traces of run '%s' in '%s'" % (args.traced_run_id, args.trace_dir))
+
+    store = ResultStore(args.results_path)
+
+    # Traces are also written for sensitivities whose results a search discards. Only those the traced run stored, if
+    # it is in the results database, are scored.
+    stored = set(store.query(run_id=args.traced_run_id)[['engine', 'keyword', 'snr_db', 'sensitivity']].tolist())
+    for (keyword, engine, snr_db), result in rescore(traced_run_dir, args.tolerance_sec).items():
+        if len(stored) > 0:
+            result = dict((x, y) for x, y in result.items() if (engine, keyword, snr_db, x) in stored)
+        if len(result) > 0:
+            store.insert(args.run_id, engine, keyword, snr_db, result)
+    store.close()
@@ -0,0 +1,335 @@
+#
+# Copyright 2018 Picovoice Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import pickle
+import resource
+import sys
+import tempfile
+import time
+from collections import namedtuple
+
+import numpy as np
+import soundfile
+
+import audio
+import benchmark
+from dataset import (
+    Dataset,
+    Datasets
+)
+from engine import (
+    Engine,
+    ExternalEngine,
+    SensitivityInfo
+)
+from mixer import create_test_files
+
+logging.basicConfig(format='%(asctime)s:%(levelname)s:%(message)s', level=logging.INFO)
+
+KEYWORD = 'alexa'
+
+NULL_ENGINE = ExternalEngine('Null')
+
+_WORDS = ['THE', 'OF', 'AND', 'TO', 'IN', 'WAS', 'HE', 'THAT', 'IT', 'HIS', 'HER', 'WITH', 'AS', 'HAD', 'FOR', 'YOU']
+
+StageResult = namedtuple('StageResult', 'startup_sec, throughput, unit, peak_rss_mb')
+
+
+# Engine that does no work, so that the benchmark measures the harness around the engines. It detects at random, more
+# often at higher sensitivities, so that there is something to score.
+class NullEngine(Engine):
+    def __init__(self, keyword, sensitivity, **kwargs):
+        super(NullEngine, self).__init__()
+
+        self._random = np.random.RandomState(seed=778)
+        self.set_sensitivity(sensitivity)
+
+    @staticmethod
+    def sensitivity_range():
+        return SensitivityInfo(0, 1, 0.1)
+
+    def set_sensitivity(self, sensitivity):
+        self._probability = sensitivity * 1e-3
+
+    def _process(self, frame):
+        return self._random.uniform() < self._probability
+
+    def _reset(self):
+        self._random = np.random.RandomState(seed=778)
+
+    def release(self):
+        pass
+
+    def __str__(self):
+        return 'Null'
+
+
+def _write_pcm(path, pcm, random):
+    soundfile.write(path, (pcm * random.uniform(0.1, 0.5)).astype(np.float32), Dataset.sample_rate(), subtype='PCM_16')
+
+
+def _tones(length_sec, random):
+    t = np.arange(int(length_sec * Dataset.sample_rate())) / Dataset.sample_rate()
+    envelope = 0.5 * (1 + np.sin(2 * np.pi * random.uniform(1, 5) * t))
+
+    return np.sin(2 * np.pi * random.uniform(100, 2000) * t) * envelope + random.randn(t.size) * 0.01
+
+
+def _noise(length_sec, random):
+    pcm = np.cumsum(random.randn(int(length_sec * Dataset.sample_rate())))
+    pcm -= np.convolve(pcm, np.ones(64) / 64, mode='same')
+
+    return pcm / np.abs(pcm).max()
+
+
+# Datasets laid out like the keyword, LibriSpeech and DEMAND datasets, made of tones and noise instead of speech.
+def create_synthetic_datasets(path, num_keywords=20, num_speakers=10, num_utterances=20, num_noises=4):
+    random = np.random.RandomState(seed=778)
+
+    os.makedirs(os.path.join(path, 'keyword'))
+    for i in range(num_keywords):
+        _write_pcm(
+            os.path.join(path, 'keyword', '%s_%d.wav' % (KEYWORD, i)), _tones(random.uniform(0.6, 1.2), random), random)
+
+    for speaker_id in range(num_speakers):
+        chapter_path = os.path.join(path, 'librispeech', str(speaker_id), '0')
+        os.makedirs(chapter_path)
+
+        with open(os.path.join(chapter_path, '%d-0.trans.txt' % speaker_id), 'w') as f:
+            for i in range(num_utterances):
+                utterance_id = '%d-0-%04d' % (speaker_id, i)
+                _write_pcm(
+                    os.path.join(chapter_path, '%s.flac' % utterance_id), _tones(random.uniform(4, 16), random), random)
+                f.write('%s %s\n' % (utterance_id, ' '.join(random.choice(_WORDS, random.randint(8, 30)))))
+
+    for i in range(num_noises):
+        os.makedirs(os.path.join(path, 'demand', 'NOISE%d' % i))
+        _write_pcm(os.path.join(path, 'demand', 'NOISE%d' % i, 'ch01.wav'), _noise(60, random), random)
+
+
+def _datasets(path):
+    keyword_dataset = Dataset.create(Datasets.KEYWORD, os.path.join(path, 'keyword'))
+    background_dataset = Dataset.create(
+        Datasets.LIBRI_SPEECH, os.path.join(path, 'librispeech'), exclude_words=[KEYWORD])
+    noise_dataset = Dataset.create(Datasets.DEMAND, os.path.join(path, 'demand'))
+
+    return keyword_dataset, background_dataset, noise_dataset
+
+
+def _set_job_context(path, options):
+    Engine.register(NULL_ENGINE, NullEngine)
+
+    args = benchmark.parser.parse_args([
+        '--librispeech_dataset_path', os.path.join(path, 'librispeech'),
+        '--demand_dataset_path', os.path.join(path, 'demand'),
+        '--keyword', KEYWORD,
+        '--access-key', '',
+        '--trace-dir', os.path.join(path, 'traces'),
+        '--checkpoint-interval-sec', '1e9'])
+    benchmark.set_job_context(dict(
+        args=vars(args),
+        test_files={KEYWORD: benchmark.test_file_paths(path, KEYWORD)},
+        checkpoint_path=os.path.join(path, 'checkpoints')),
+        args.access_key)
+
+    info = NullEngine.sensitivity_range()
+    return [float(x) for x in np.linspace(info.min, info.max, options['num_sensitivities'])]
+
+
+def _audio_hours(num_samples):
+    return num_samples / (Dataset.sample_rate() * 3600)
+
+
+# Each stage sets up, calls `ready` and then does the work that is timed. It returns the amount of work done and its
+# unit. Stages run in order and later ones use the files written by earlier ones.
+def _dataset_stage(path, options, ready):
+    _, background_dataset, noise_dataset = _datasets(path)
+    ready()
+
+    num_samples = 0
+    for i in range(background_dataset.size()):
+        num_samples += background_dataset.get(i).size
+    for i in range(noise_dataset.size()):
+        num_samples += noise_dataset.get_normalized(i).size
+
+    return _audio_hours(num_samples), 'audio-hours'
+
+
+def _mixer_stage(path, options, ready):
+    keyword_dataset, background_dataset, noise_dataset = _datasets(path)
+    ready()
+
+    speech_path, label_path = benchmark.test_file_paths(path, KEYWORD)
+    create_test_files(
+        speech_path=speech_path,
+        label_path=label_path,
+        keyword_dataset=keyword_dataset,
+        background_dataset=background_dataset,
+        noise_dataset=noise_dataset,
+        length_hour=options['length_hour'])
+    audio.convert_to_raw(speech_path)
+
+    return options['length_hour'], 'audio-hours'
+
+
+def _run_stage(path, options, ready):
+    sensitivities = _set_job_context(path, options)
+    _, num_frames, _, _ = benchmark.load_test_data(KEYWORD)
+    ready()
+
+    res = benchmark.run(NULL_ENGINE, KEYWORD, None, sensitivities)
+    with open(os.path.join(path, 'run.pkl'), 'wb') as f:
+        pickle.dump(res, f)
+
+    return num_frames * len(sensitivities), 'frames'
+
+
+def _score_stage(path, options, ready):
+    sensitivities = _set_job_context(path, options)
+    _, num_frames, _, _ = benchmark.load_test_data(KEYWORD)
+    with open(os.path.join(path, 'run.pkl'), 'rb') as f:
+        shard_results = [pickle.load(f)]
+    ready()
+
+    benchmark.merge(NULL_ENGINE, KEYWORD, None, shard_results)
+
+    return num_frames * len(sensitivities), 'frames'
+
+
+STAGES = {
+    'dataset': _dataset_stage,
+    'mixer': _mixer_stage,
+    'run': _run_stage,
+    'score': _score_stage,
+}
+
+
+def _stage_process(stage, path, options, connection):
+    start_sec = [0.]
+
+    def ready():
+        connection.send('ready')
+        start_sec[0] = time.perf_counter()
+
+    amount, unit = STAGES[stage](path, options, ready)
+    connection.send((amount / (time.perf_counter() - start_sec[0]), '%s/s' % unit, _peak_rss_mb()))
+
+
+def _peak_rss_mb():
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return peak_rss / 2 ** 20 if sys.platform == 'darwin' else peak_rss / 2 ** 10
+
+
+# Every stage runs in a fresh process so that its startup time (interpreter, imports and setup until the stage is
+# ready) and peak memory are its own.
+def run_stage(stage, path, options):
+    connection, child_connection = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.get_context('spawn').Process(
+        target=_stage_process,
+        args=(stage, path, options, child_connection))
+
+    start_sec = time.perf_counter()
+    process.start()
+    child_connection.close()
+    try:
+        connection.recv()
+        startup_sec = time.perf_counter() - start_sec
+        throughput, unit, peak_rss_mb = connection.recv()
+    except EOFError:
+        raise RuntimeError("stage '%s' failed" % stage)
+    finally:
+        process.join()
+
+    return StageResult(startup_sec, throughput, unit, peak_rss_mb)
+
+
+# Relative change of each metric with respect to the baseline.
+def changes(result, baseline):
+    return dict(
+        startup_sec=result.startup_sec / baseline.startup_sec - 1,
+        throughput=result.throughput / baseline.throughput - 1,
+        peak_rss_mb=result.peak_rss_mb / baseline.peak_rss_mb - 1)
+
+
+def _regressed(metric, change, tolerance):
+    return change < -tolerance if metric == 'throughput' else change > tolerance
+
+
+def _format(value, change):
+    return '%.4g' % value if change is None else '%.4g (%+.0f%%)' % (value, change * 100)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--stages', nargs='+', choices=list(STAGES.keys()), default=list(STAGES.keys()))
+    parser.add_argument('--length-hour', type=float, default=0.25, help='length of the generated test audio')
+    parser.add_argument('--num-sensitivities', type=int, default=5)
+    parser.add_argument('--baseline-path', default=os.path.join(os.path.dirname(__file__), 'self_benchmark.json'))
+    parser.add_argument(
+        '--save-baseline',
+        action='store_true',
+        help='store the results as the new baseline instead of comparing against it')
+    parser.add_argument(
+        '--tolerance',
+        type=float,
+        default=0.25,
+        help='relative change of a metric beyond which it is reported as a regression')
+    args = parser.parse_args()
+
+    options = dict(length_hour=args.length_hour, num_sensitivities=args.num_sensitivities)
+
+    baseline = dict()
+    if not args.save_baseline and os.path.exists(args.baseline_path):
+        with open(args.baseline_path) as f:
+            x = json.load(f)
+        if x['options'] == options:
+            baseline = dict((k, StageResult(**v)) for k, v in x['stages'].items())
+        else:
+            logging.warning('baseline was measured with %s, not comparing against it' % x['options'])
+
+    results = dict()
+    with tempfile.TemporaryDirectory() as path:
+        create_synthetic_datasets(path)
+        stages = list(STAGES.keys())
+        for stage in stages[:(max(stages.index(x) for x in args.stages) + 1)]:
+            results[stage] = run_stage(stage, path, options)
+            logging.info("finished stage '%s'" % stage)
+
+    failed = list()
+    print('%-10s %-20s %-30s %-20s' % ('stage', 'startup (s)', 'throughput', 'peak RSS (MB)'))
+    for stage in args.stages:
+        result = results[stage]
+        stage_changes = changes(result, baseline[stage]) if stage in baseline else dict()
+        print('%-10s %-20s %-30s %-20s' % (
+            stage,
+            _format(result.startup_sec, stage_changes.get('startup_sec')),
+            '%s %s' % (_format(result.throughput, stage_changes.get('throughput')), result.unit),
+            _format(result.peak_rss_mb, stage_changes.get('peak_rss_mb'))))
+        failed.extend('%s %s' % (stage, k) for k, v in stage_changes.items() if _regressed(k, v, args.tolerance))
+
+    if args.save_baseline:
+        with open(args.baseline_path, 'w') as f:
+            json.dump(dict(options=options, stages=dict((k, v._asdict()) for k, v in results.items())), f, indent=2)
+        logging.info("saved the baseline to '%s'" % args.baseline_path)
+    elif len(failed) > 0:
+        logging.error('regressed beyond %.0f%%: %s' % (args.tolerance * 100, ', '.join(failed)))
+        sys.exit(1)
@@ -0,0 +1,327 @@
+#
+# Copyright 2018 Picovoice Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import contextlib
+import itertools
+import logging
+import os
+import pickle
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+
+
+def _lease_expired_error(attempt):
+    return 'the lease of the task expired %d times' % attempt
+
+
+# Queue kept in a directory, e.g. on storage shared by all hosts. A task is a file that moves from `pending` to
+# `claimed` by an atomic rename. A worker that holds a task touches its file while working on it and tasks whose file
+# has not been touched for `lease_sec` are put back to `pending`. The first result written for a task wins.
+class FileSystemQueue(object):
+    def __init__(self, path, max_attempts=3, lease_sec=600):
+        self._path = path
+        self._max_attempts = max_attempts
+        self._lease_sec = lease_sec
+        self._reported = set()
+
+        for x in ('pending', 'claimed', 'done'):
+            os.makedirs(os.path.join(self._path, x), exist_ok=True)
+
+    def reset(self):
+        for x in ('pending', 'claimed', 'done'):
+            shutil.rmtree(os.path.join(self._path, x))
+            os.makedirs(os.path.join(self._path, x))
+        self._reported.clear()
+
+    def set_context(self, context):
+        self._write(os.path.join(self._path, 'context.pkl'), context)
+
+    def context(self):
+        try:
+            return self._read(os.path.join(self._path, 'context.pkl'))
+        except FileNotFoundError:
+            return None
+
+    def put(self, task_id, task):
+        self._write(self._task_path('pending', task_id), dict(task=task, attempt=0))
+
+    def claim(self):
+        self._requeue_expired()
+
+        for task_id in self._task_ids('pending'):
+            try:
+                os.utime(self._task_path('pending', task_id))
+                os.rename(self._task_path('pending', task_id), self._task_path('claimed', task_id))
+                return task_id, self._read(self._task_path('claimed', task_id))['task']
+            except FileNotFoundError:
+                continue
+
+        return None
+
+    def renew(self, task_id):
+        try:
+            os.utime(self._task_path('claimed', task_id))
+        except FileNotFoundError:
+            pass
+
+    def complete(self, task_id, result):
+        self._finish(task_id, result, None)
+        self._remove(self._task_path('claimed', task_id))
+
+    def fail(self, task_id, error):
+        self._retry(self._task_path('claimed', task_id), task_id, error)
+
+    def results(self):
+        res = list()
+        for task_id in self._task_ids('done'):
+            if task_id not in self._reported:
+                x = self._read(self._task_path('done', task_id))
+                res.append((task_id, x['result'], x['error']))
+                self._reported.add(task_id)
+
+        return res
+
+    def _requeue_expired(self):
+        for task_id in self._task_ids('claimed'):
+            path = self._task_path('claimed', task_id)
+            try:
+                if os.path.getmtime(path) < time.time() - self._lease_sec:
+                    self._retry(path, task_id, None)
+            except FileNotFoundError:
+                continue
+
+    def _retry(self, path, task_id, error):
+        # Moving the task aside first makes sure that only one process retries it.
+        private_path = '%s.%s' % (path, uuid.uuid4().hex)
+        try:
+            os.rename(path, private_path)
+        except FileNotFoundError:
+            return
+
+        x = self._read(private_path)
+        attempt = x['attempt'] + 1
+        if attempt < self._max_attempts:
+            self._write(self._task_path('pending', task_id), dict(task=x['task'], attempt=attempt))
+        else:
+            self._finish(task_id, None, error if error is not None else _lease_expired_error(attempt))
+        os.remove(private_path)
+
+    def _finish(self, task_id, result, error):
+        tmp_path = os.path.join(self._path, 'done', '%s.tmp' % uuid.uuid4().hex)
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(dict(result=result, error=error), f)
+
+        try:
+            os.link(tmp_path, self._task_path('done', task_id))
+        except FileExistsError:
+            pass
+        os.remove(tmp_path)
+
+    def _task_ids(self, state):
+        return sorted(x[:-len('.pkl')] for x in os.listdir(os.path.join(self._path, state)) if x.endswith('.pkl'))
+
+    def _task_path(self, state, task_id):
+        return os.path.join(self._path, state, '%s.pkl' % task_id)
+
+    @staticmethod
+    def _read(path):
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+    @staticmethod
+    def _write(path, x):
+        tmp_path = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(x, f)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+# Same semantics as `FileSystemQueue`, kept in one SQLite database.
+class SQLiteQueue(object):
+    def __init__(self, path, max_attempts=3, lease_sec=600):
+        self._max_attempts = max_attempts
+        self._lease_sec = lease_sec
+
+        self._connection = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self._connection.execute('CREATE TABLE IF NOT EXISTS context (id INTEGER PRIMARY KEY, context BLOB)')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS tasks '
+            '(task_id TEXT PRIMARY KEY, task BLOB, attempt INTEGER, state TEXT, lease_expires REAL, result BLOB, '
+            'error TEXT, reported INTEGER)')
+
+    def reset(self):
+        self._connection.execute('DELETE FROM tasks')
+
+    def set_context(self, context):
+        self._connection.execute('INSERT OR REPLACE INTO context VALUES (0, ?)', (pickle.dumps(context),))
+
+    def context(self):
+        row = self._connection.execute('SELECT context FROM context WHERE id = 0').fetchone()
+        return None if row is None else pickle.loads(row[0])
+
+    def put(self, task_id, task):
+        self._connection.execute(
+            "INSERT INTO tasks VALUES (?, ?, 0, 'pending', NULL, NULL, NULL, 0)", (task_id, pickle.dumps(task)))
+
+    def claim(self):
+        now = time.time()
+        with self._transaction():
+            expired = self._connection.execute(
+                "SELECT task_id, attempt FROM tasks WHERE state = 'claimed' AND lease_expires < ?", (now,)).fetchall()
+            for task_id, attempt in expired:
+                self._retry(task_id, attempt, None)
+
+            row = self._connection.execute(
+                "SELECT task_id, task FROM tasks WHERE state = 'pending' ORDER BY task_id LIMIT 1").fetchone()
+            if row is None:
+                return None
+
+            self._connection.execute(
+                "UPDATE tasks SET state = 'claimed', lease_expires = ? WHERE task_id = ?",
+                (now + self._lease_sec, row[0]))
+
+        return row[0], pickle.loads(row[1])
+
+    def renew(self, task_id):
+        self._connection.execute(
+            "UPDATE tasks SET lease_expires = ? WHERE task_id = ? AND state = 'claimed'",
+            (time.time() + self._lease_sec, task_id))
+
+    def complete(self, task_id, result):
+        self._connection.execute(
+            "UPDATE tasks SET state = 'done', result = ? WHERE task_id = ? AND state != 'done'",
+            (pickle.dumps(result), task_id))
+
+    def fail(self, task_id, error):
+        with self._transaction():
+            row = self._connection.execute(
+                "SELECT attempt FROM tasks WHERE task_id = ? AND state = 'claimed'", (task_id,)).fetchone()
+            if row is not None:
+                self._retry(task_id, row[0], error)
+
+    def results(self):
+        with self._transaction():
+            rows = self._connection.execute(
+                "SELECT task_id, result, error FROM tasks WHERE state = 'done' AND reported = 0").fetchall()
+            self._connection.execute("UPDATE tasks SET reported = 1 WHERE state = 'done'")
+
+        return [(x, None if y is None else pickle.loads(y), z) for x, y, z in rows]
+
+    def _retry(self, task_id, attempt, error):
+        attempt += 1
+        if attempt < self._max_attempts:
+            self._connection.execute(
+                "UPDATE tasks SET state = 'pending', attempt = ? WHERE task_id = ?", (attempt, task_id))
+        else:
+            self._connection.execute(
+                "UPDATE tasks SET state = 'done', attempt = ?, error = ? WHERE task_id = ?",
+                (attempt, error if error is not None else _lease_expired_error(attempt), task_id))
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        self._connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            self._connection.execute('ROLLBACK')
+            raise
+        self._connection.execute('COMMIT')
+
+
+QUEUE_BACKENDS = {
+    'file': FileSystemQueue,
+    'sqlite': SQLiteQueue,
+}
+
+
+# `url` is `<backend>://<path>`, e.g. `sqlite:///shared/queue.db`. A plain path refers to a `FileSystemQueue`.
+def open_queue(url, **kwargs):
+    backend, separator, path = url.partition('://')
+    if not separator:
+        backend, path = 'file', url
+
+    if backend not in QUEUE_BACKENDS:
+        raise ValueError("unknown work queue backend '%s'" % backend)
+
+    return QUEUE_BACKENDS[backend](path, **kwargs)
+
+
+# Drop-in replacement for `multiprocessing.Pool` as used by `Scheduler`. Tasks are published to a work queue and run by
+# `worker.py` processes on any host that can reach it. `context` is handed to the workers before they run a task of this
+# job. The functions run by tasks are looked up by name in `benchmark.py`.
+class QueuePool(object):
+    def __init__(self, work_queue, context, poll_interval_sec=1.):
+        self._queue = work_queue
+        self._poll_interval_sec = poll_interval_sec
+
+        self._job_id = uuid.uuid4().hex[:16]
+        self._task_ids = itertools.count()
+        self._callbacks = dict()
+        self._lock = threading.Lock()
+
+        self._queue.reset()
+        self._queue.set_context(dict(context, job_id=self._job_id))
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._poll, daemon=True)
+        self._thread.start()
+
+    def apply_async(self, func, args, callback=None, error_callback=None):
+        task_id = '%s-%08d' % (self._job_id, next(self._task_ids))
+        with self._lock:
+            self._callbacks[task_id] = callback, error_callback
+            self._queue.put(task_id, dict(job_id=self._job_id, func=func.__name__, args=args))
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+
+        self._queue.set_context(None)
+        self._queue.reset()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _poll(self):
+        while not self._stop.wait(self._poll_interval_sec):
+            try:
+                with self._lock:
+                    results = self._queue.results()
+            except Exception:
+                logging.exception('failed to poll the work queue for results')
+                continue
+
+            for task_id, result, error in results:
+                with self._lock:
+                    callback, error_callback = self._callbacks.pop(task_id, (None, None))
+
+                if error is None and callback is not None:
+                    callback(result)
+                elif error is not None and error_callback is not None:
+                    error_callback(RuntimeError("task '%s' failed: %s" % (task_id, error)))
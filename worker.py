@@ -0,0 +1,100 @@
+#
+# Copyright 2018 Picovoice Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import argparse
+import logging
+import multiprocessing
+import os
+import socket
+import threading
+import time
+import traceback
+
+import benchmark
+from work_queue import open_queue
+
+
+def work(queue_url, access_key, lease_sec=600, poll_interval_sec=1.):
+    work_queue = open_queue(queue_url, lease_sec=lease_sec)
+    worker_id = '%s-%s' % (socket.gethostname(), multiprocessing.current_process().name)
+
+    job_id = None
+    while True:
+        claimed = work_queue.claim()
+        if claimed is None:
+            time.sleep(poll_interval_sec)
+            continue
+
+        task_id, task = claimed
+        if task['job_id'] != job_id:
+            context = work_queue.context()
+            if context is None or context['job_id'] != task['job_id']:
+                work_queue.fail(task_id, 'the task does not belong to the current job')
+                continue
+
+            benchmark.set_job_context(context, access_key)
+            job_id = task['job_id']
+
+        logging.info("[%s] running task '%s'" % (worker_id, task_id))
+
+        # The lease of the task is renewed while it runs so that it is not handed out to another worker.
+        done = threading.Event()
+
+        def renew():
+            while not done.wait(lease_sec / 3):
+                work_queue.renew(task_id)
+
+        renew_thread = threading.Thread(target=renew, daemon=True)
+        renew_thread.start()
+
+        try:
+            result = getattr(benchmark, task['func'])(*task['args'])
+        except Exception:
+            logging.exception("[%s] task '%s' failed" % (worker_id, task_id))
+            work_queue.fail(task_id, traceback.format_exc())
+            continue
+        finally:
+            done.set()
+            renew_thread.join()
+
+        work_queue.complete(task_id, result)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--queue', required=True, help='work queue of the coordinating benchmark.py run')
+    parser.add_argument(
+        '--access-key',
+        default=os.environ.get('ACCESS_KEY'),
+        help='access key of the engines, taken from the ACCESS_KEY environment variable by default')
+    parser.add_argument('--num-processes', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument(
+        '--lease-sec',
+        type=float,
+        default=600,
+        help='a task is handed to another worker if its worker has not renewed it within this time')
+    args = parser.parse_args()
+
+    if args.access_key is None:
+        parser.error('an access key is needed, pass --access-key or set the ACCESS_KEY environment variable')
+
+    processes = [
+        multiprocessing.Process(target=work, args=(args.queue, args.access_key, args.lease_sec))
+        for _ in range(args.num_processes)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()